@@ -1,6 +1,8 @@
 import os
 import json
 import logging
+import asyncio
+from contextlib import asynccontextmanager
 
 logger = logging.getLogger("uvicorn.error")
 logger.setLevel(logging.DEBUG)
@@ -10,53 +12,251 @@ from dotenv import load_dotenv
 
 load_dotenv()
 service_account_file = os.getenv("SERVICE_ACCOUNT_FILE") or "credentials.json"
+discovery_cache_file = os.getenv("DISCOVERY_CACHE_FILE") or ".discovery.json"
 
-from .routers import archives, manage_itineraries, update_itineraries
-from .handlers.google_auth import get_credentials
-from .handlers.google_drive import list_folders, list_spreadsheets
+from .routers import (
+    archives,
+    manage_itineraries,
+    update_itineraries,
+    search,
+    metrics,
+)
+from .handlers.google_auth import get_credentials, CredentialManager
+from .handlers.google_service import close_pools
+from .handlers.discovery import discover, load_discovery, save_discovery
+from .handlers.executor import run_sync
+from .handlers.itinerary_cache import ItineraryCache
+from .handlers.write_behind import WriteBehindQueue
+from .handlers.drive_sync import FolderIndex
+from .handlers.replica import Replica
+from .handlers.template_pool import TemplatePool
+from .handlers.search_index import SearchIndex
+from .handlers.shared_cache import SharedCache, open_backend
+from .handlers.single_flight import SingleFlight
+from .handlers import metrics as upstream_metrics
 
 with open(service_account_file) as file:
     service_account_info = json.load(file)
 
 # credentials = get_credentials(service_account_file=service_account_file)
 credentials = get_credentials(service_account_info=service_account_info)
+account = service_account_info.get("client_email")
 
-# find file ids
-folders = dict([[folder["name"], folder["id"]] for folder in list_folders(credentials)])
-template = [
-    file
-    for file in list_spreadsheets(credentials, folders["Templates"])
-    if file["name"] == "Itinerary"
-]
+# refresh the access token ahead of expiry, optionally shared between workers
+credential_manager = CredentialManager(
+    credentials,
+    token_file=os.getenv("TOKEN_CACHE_FILE"),
+    margin=float(os.getenv("TOKEN_REFRESH_MARGIN") or 300),
+)
 
-if "Itineraries" in folders:
-    logger.debug(f"Found folder `Itineraries`: {folders["Itineraries"]}")
-else:
-    raise FileNotFoundError("Could not find `Itineraries` folder")
+# share file ids, listings and itinerary reads between worker processes
+shared_cache_url = os.getenv("SHARED_CACHE_URL")
+shared_cache = (
+    SharedCache(
+        open_backend(shared_cache_url),
+        ttl=float(os.getenv("SHARED_CACHE_TTL") or 300),
+    )
+    if shared_cache_url
+    else None
+)
 
-if "Archives" in folders:
-    logger.debug(f"Found folder `Archives`   : {folders["Archives"]}")
-else:
-    raise FileNotFoundError("Could not find `Archives` folder")
 
-if "Templates" in folders:
-    logger.debug(f"Found folder `Templates`  : {folders["Templates"]}")
-else:
-    raise FileNotFoundError("Could not find `Templates` folder")
+def find_ids(templates_id=None):
+    if shared_cache is None:
+        return discover(credentials, templates_id)
 
-if template:
-    template_id = template[0]["id"]
-    logger.debug(f"Found spreadsheet `Templates/Itinerary`: {template_id}")
-else:
-    raise FileNotFoundError("Could not find template itinerary")
+    # one worker looks the ids up, the others use its result
+    return shared_cache.get_or_fetch(
+        f"discovery:{account}", lambda: discover(credentials, templates_id)
+    )
 
 
-api = FastAPI()
+def configure(app, discovery):
+    """Apply discovered file ids and set up the workers that depend on them."""
+    folders = discovery["folders"]
+
+    logger.debug(f"Found folder `Itineraries`: {folders['Itineraries']}")
+    logger.debug(f"Found folder `Archives`   : {folders['Archives']}")
+    logger.debug(f"Found folder `Templates`  : {folders['Templates']}")
+    logger.debug(f"Found spreadsheet `Templates/Itinerary`: {discovery['template_id']}")
+
+    app.folders = folders
+    app.template_id = discovery["template_id"]
+
+    # keep an index of the itinerary folders from the drive changes feed
+    drive_sync_interval = float(os.getenv("DRIVE_SYNC_INTERVAL") or 0)
+    app.folder_index = (
+        FolderIndex(
+            credentials,
+            [folders["Itineraries"], folders["Archives"]],
+            interval=drive_sync_interval,
+            max_staleness=float(os.getenv("DRIVE_SYNC_MAX_STALENESS") or 60),
+        )
+        if drive_sync_interval
+        else None
+    )
+
+    # mirror all itinerary rows into a local sqlite file
+    replica_path = os.getenv("REPLICA_PATH")
+    app.replica = (
+        Replica(
+            replica_path,
+            credentials,
+            [folders["Itineraries"], folders["Archives"]],
+            interval=float(os.getenv("REPLICA_SYNC_INTERVAL") or 300),
+            folder_index=app.folder_index,
+        )
+        if replica_path
+        else None
+    )
+
+    # keep copies of the template ready for new itineraries
+    template_pool_size = int(os.getenv("TEMPLATE_POOL_SIZE") or 0)
+    app.template_pool = (
+        TemplatePool(
+            credentials,
+            app.template_id,
+            folders["Templates"],
+            size=template_pool_size,
+            concurrency=int(os.getenv("TEMPLATE_POOL_CONCURRENCY") or 2),
+            max_age=float(os.getenv("TEMPLATE_POOL_MAX_AGE") or 86400),
+            interval=float(os.getenv("TEMPLATE_POOL_INTERVAL") or 300),
+        )
+        if template_pool_size
+        else None
+    )
+
+    # index the rows of every itinerary for /search
+    search_interval = float(os.getenv("SEARCH_INDEX_INTERVAL") or 0)
+    app.search_index = (
+        SearchIndex(
+            credentials,
+            [folders["Itineraries"], folders["Archives"]],
+            interval=search_interval,
+            concurrency=int(os.getenv("SEARCH_INDEX_CONCURRENCY") or 4),
+            folder_index=app.folder_index,
+            replica=app.replica,
+        )
+        if search_interval
+        else None
+    )
+
+    return [
+        asyncio.create_task(worker.run())
+        for worker in (
+            app.folder_index,
+            app.replica,
+            app.template_pool,
+            app.search_index,
+        )
+        if worker
+    ]
+
+
+@asynccontextmanager
+async def lifespan(app):
+    cached = load_discovery(discovery_cache_file, account)
+    tasks = []
+    revalidation = None
+    refresher = asyncio.create_task(credential_manager.run())
+
+    async def revalidate():
+        nonlocal tasks
+        try:
+            discovery = await run_sync(find_ids, cached["folders"]["Templates"])
+        except Exception as error:
+            logger.error(f"Could not revalidate cached file ids: {error}")
+            return
+
+        if discovery != cached:
+            logger.warning("Cached file ids are out of date, reconfiguring")
+            save_discovery(discovery_cache_file, account, discovery)
+            for task in tasks:
+                task.cancel()
+            if app.template_pool:
+                await run_sync(app.template_pool.close)
+            tasks = configure(app, discovery)
+
+    if cached:
+        # serve from the cached ids right away, check them in the background
+        tasks = configure(app, cached)
+        revalidation = asyncio.create_task(revalidate())
+    else:
+        discovery = await run_sync(find_ids)
+        save_discovery(discovery_cache_file, account, discovery)
+        tasks = configure(app, discovery)
+
+    yield
+
+    for task in [*tasks, revalidation, refresher]:
+        if task:
+            task.cancel()
+
+    if app.write_behind:
+        await app.write_behind.drain()
+
+    if app.template_pool:
+        await run_sync(app.template_pool.close)
+
+    # the pooled clients' connections are no longer needed
+    close_pools()
+
+
+api = FastAPI(lifespan=lifespan)
 
 api.credentials = credentials
-api.folders = folders
-api.template_id = template_id
+api.credential_manager = credential_manager
+api.shared_cache = shared_cache
+api.folders = {}
+api.template_id = None
+api.folder_index = None
+api.replica = None
+api.template_pool = None
+api.search_index = None
+api.itinerary_cache = ItineraryCache(
+    max_size=int(os.getenv("ITINERARY_CACHE_SIZE") or 128),
+    ttl=float(os.getenv("ITINERARY_CACHE_TTL") or 300),
+)
+# share identical reads in flight, optionally serve them stale while refreshing
+api.single_flight = SingleFlight(
+    max_age=float(os.getenv("READ_MAX_AGE") or 0),
+    stale_while_revalidate=float(os.getenv("READ_STALE_WHILE_REVALIDATE") or 0),
+)
+
+
+def forget_itinerary(id):
+    api.itinerary_cache.invalidate(id)
+    api.single_flight.forget(id)
+    if api.shared_cache:
+        api.shared_cache.delete(f"itinerary:{id}")
+    if api.replica:
+        api.replica.invalidate(id)
 
-api.include_router(manage_itineraries.router, prefix="/itineraries", tags=["itineraries"])
-api.include_router(update_itineraries.router, prefix="/itineraries", tags=["activities"])
+
+# buffer row writes and flush them in batches, disabled unless a delay is set
+write_behind_delay = float(os.getenv("WRITE_BEHIND_DELAY") or 0)
+api.write_behind = (
+    WriteBehindQueue(
+        credentials,
+        delay=write_behind_delay,
+        max_size=int(os.getenv("WRITE_BEHIND_MAX_SIZE") or 50),
+        max_retries=int(os.getenv("WRITE_BEHIND_MAX_RETRIES") or 3),
+        on_flush=forget_itinerary,
+    )
+    if write_behind_delay
+    else None
+)
+
+api.include_router(
+    manage_itineraries.router, prefix="/itineraries", tags=["itineraries"]
+)
+api.include_router(
+    update_itineraries.router, prefix="/itineraries", tags=["activities"]
+)
 api.include_router(archives.router, prefix="/archives", tags=["archives"])
+api.include_router(search.router, prefix="/search", tags=["search"])
+
+# count google api calls per request and expose them with the component stats
+if upstream_metrics.ENABLED:
+    api.middleware("http")(upstream_metrics.upstream_middleware)
+    api.include_router(metrics.router, prefix="/metrics", include_in_schema=False)
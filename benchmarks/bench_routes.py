@@ -0,0 +1,293 @@
+"""Latency and upstream call counts of every route, against a local fake Google.
+
+Starts benchmarks/fake_google.py in a separate process, points the api
+clients at it with GOOGLE_API_ENDPOINT and drives each route in-process
+through httpx. No credentials or network access are needed. Run from the
+project root:
+python -m benchmarks.bench_routes [--requests 200] [--concurrency 10]
+"""
+
+import io
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import importlib
+import statistics
+import multiprocessing
+from pathlib import Path
+from contextlib import redirect_stdout, nullcontext
+
+import httpx
+
+from benchmarks.fake_credentials import write_service_account_file
+from benchmarks import fake_google
+
+root = Path(__file__).resolve().parents[1]
+
+ROW = {
+    "name": "Hiking",
+    "location_1": "Red Rock Canyon State Park",
+    "location_2": "Nightmare Gulch",
+    "cost": 6,
+    "date_start": "2024-11-30",
+    "date_end": "2024-11-30",
+}
+
+
+# files moved or deleted by each bulk request
+BULK = 2
+
+
+def scenarios(seeded, requests):
+    itineraries = seeded["Itineraries"]
+    archives = seeded["Archives"]
+    # archiving, restoring and purging use up files, give each request its own
+    readable = itineraries[:requests]
+    archivable = iter(itineraries[requests : requests * 2])
+    bulk_archivable = iter(itineraries[requests * 2 :])
+    archived = iter(archives[:requests])
+    restorable = iter(archives[requests:])
+
+    def pick():
+        return random.choice(readable)
+
+    def take(files):
+        ids = [next(files) for _ in range(BULK)]
+        return {"json": {"ids": ids}}
+
+    return {
+        "list itineraries": lambda: ("GET", "/itineraries", {}),
+        "list archives": lambda: ("GET", "/archives", {}),
+        "list page": lambda: (
+            "GET",
+            "/itineraries",
+            # the fake server's page tokens are offsets into the listing
+            {
+                "params": {
+                    "page_size": 20,
+                    "cursor": str(20 * random.randrange(len(itineraries) // 20)),
+                }
+            },
+        ),
+        "stream listing": lambda: (
+            "GET",
+            "/itineraries",
+            {"params": {"format": "ndjson"}},
+        ),
+        "read itinerary": lambda: ("GET", f"/itineraries/{pick()}", {}),
+        "stream category": lambda: ("GET", f"/itineraries/{pick()}/activities", {}),
+        "export itinerary": lambda: (
+            "GET",
+            f"/itineraries/{pick()}/export",
+            {"params": {"format": "csv"}},
+        ),
+        "export zip": lambda: (
+            "GET",
+            "/itineraries/export",
+            {"params": {"ids": random.sample(readable, 3), "format": "csv"}},
+        ),
+        "search": lambda: (
+            "GET",
+            "/search",
+            {"params": {"q": random.choice(["red rock", "nightmare gulch", "stop"])}},
+        ),
+        "metrics": lambda: ("GET", "/metrics", {}),
+        "append row": lambda: (
+            "POST",
+            f"/itineraries/{pick()}/activities",
+            {"json": ROW},
+        ),
+        "update row": lambda: (
+            "PUT",
+            f"/itineraries/{pick()}/activities/{random.randint(1, 10)}",
+            {"json": ROW},
+        ),
+        "delete row": lambda: (
+            "DELETE",
+            f"/itineraries/{pick()}/housing/{random.randint(1, 10)}",
+            {},
+        ),
+        "batch mutation": lambda: (
+            "POST",
+            f"/itineraries/{pick()}/batch",
+            {
+                "json": [
+                    {"op": "update", "category": "housing", "index": 1, "data": ROW},
+                    {"op": "create", "category": "activities", "data": ROW},
+                ]
+            },
+        ),
+        "create itinerary": lambda: (
+            "POST",
+            "/itineraries",
+            {"json": {"name": "Benchmark", "email": "someone@example.com"}},
+        ),
+        "archive itinerary": lambda: (
+            "DELETE",
+            f"/itineraries/{next(archivable)}",
+            {},
+        ),
+        "bulk archive": lambda: (
+            "POST",
+            "/itineraries/archive",
+            take(bulk_archivable),
+        ),
+        "bulk restore": lambda: ("POST", "/archives/restore", take(restorable)),
+        "purge archived": lambda: ("DELETE", f"/archives/{next(archived)}", {}),
+        # the first request deletes every archive left, the others find none
+        "bulk purge": lambda: (
+            "POST",
+            "/archives/purge",
+            {"json": {"older_than_days": 0}},
+        ),
+    }
+
+
+async def measure(client, make_request, requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+    errors = 0
+
+    async def one():
+        nonlocal errors
+        try:
+            method, url, kwargs = make_request()
+        except StopIteration:
+            return
+
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            timings.append(time.perf_counter() - start)
+            errors += response.status_code >= 400
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(requests)])
+    return timings, errors, time.perf_counter() - start
+
+
+def percentile(timings, q):
+    return (
+        statistics.quantiles(timings, n=100)[q - 1] if len(timings) > 1 else timings[0]
+    )
+
+
+def upstream_calls(endpoint):
+    return httpx.get(endpoint + "_calls").json()
+
+
+async def main(api, endpoint, seeded, requests, concurrency, verbose):
+    transport = httpx.ASGITransport(app=api)
+    report = sys.stdout
+
+    print(
+        f"{'route':<20} {'n':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+        f" {'req/s':>8} {'calls/req':>10} {'errors':>7}"
+    )
+
+    # handlers print a line per call, keep them out of the report
+    with nullcontext() if verbose else redirect_stdout(io.StringIO()):
+        async with api.router.lifespan_context(api):
+            # search answers 503 until the index has read every itinerary
+            while api.search_index and not api.search_index.is_ready():
+                await asyncio.sleep(0.1)
+
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://benchmark"
+            ) as client:
+                for name, make_request in scenarios(seeded, requests).items():
+                    calls = sum(upstream_calls(endpoint).values())
+                    timings, errors, elapsed = await measure(
+                        client, make_request, requests, concurrency
+                    )
+                    if not timings:
+                        continue
+
+                    calls = sum(upstream_calls(endpoint).values()) - calls
+                    print(
+                        f"{name:<20} {len(timings):>5}"
+                        f" {percentile(timings, 50) * 1000:>8.1f}"
+                        f" {percentile(timings, 95) * 1000:>8.1f}"
+                        f" {percentile(timings, 99) * 1000:>8.1f}"
+                        f" {len(timings) / elapsed:>8.1f}"
+                        f" {calls / len(timings):>10.2f} {errors:>7}",
+                        file=report,
+                    )
+
+    print()
+    print("upstream calls")
+    calls = upstream_calls(endpoint)
+    for name in sorted(calls, key=calls.get, reverse=True):
+        print(f"  {name:<48} {calls[name]:>6}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--rows", type=int, default=30)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    # serve from another process so the fake doesn't compete for the GIL
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=fake_google.run,
+        args=(
+            {
+                "latency": args.latency,
+                "jitter": args.jitter,
+                "error_rate": args.error_rate,
+                "rate_limit_rate": args.rate_limit_rate,
+            },
+            {
+                "itineraries": args.requests * (2 + BULK),
+                "archives": args.requests * (1 + BULK),
+                "rows": args.rows,
+            },
+            ready,
+        ),
+        daemon=True,
+    )
+    server.start()
+    seeded = ready.get()
+    endpoint = f"http://127.0.0.1:{seeded['port']}/"
+
+    directory = tempfile.mkdtemp()
+    os.environ["SERVICE_ACCOUNT_FILE"] = os.path.join(directory, "credentials.json")
+    os.environ["DISCOVERY_CACHE_FILE"] = os.path.join(directory, "discovery.json")
+    os.environ["GOOGLE_API_ENDPOINT"] = endpoint
+    # the fake server has no quota, measure the app rather than the limiter
+    for name in [
+        "SHEETS_READS_PER_MINUTE",
+        "SHEETS_WRITES_PER_MINUTE",
+        "DRIVE_REQUESTS_PER_MINUTE",
+    ]:
+        os.environ.setdefault(name, "1000000")
+    os.environ.setdefault("SEARCH_INDEX_INTERVAL", "300")
+    os.environ.setdefault("METRICS_ENABLED", "1")
+    write_service_account_file(os.environ["SERVICE_ACCOUNT_FILE"], endpoint + "token")
+
+    # the project is a package, import it the way `fastapi dev main.py` does
+    sys.path.insert(0, str(root.parent))
+    api_module = importlib.import_module(f"{root.name}.api")
+
+    asyncio.run(
+        main(
+            api_module.api,
+            endpoint,
+            seeded,
+            args.requests,
+            args.concurrency,
+            args.verbose,
+        )
+    )
+    server.terminate()
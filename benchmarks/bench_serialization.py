@@ -0,0 +1,97 @@
+"""Encode time and payload size of an itinerary response, per serialization path.
+
+Compares validating through the `Itinerary` response model and encoding
+with the json module (what FastAPI does for the route) against the fast
+path and the columnar format in routers/serialization.py. The fast paths
+use orjson when it's installed. Run from the project root:
+python -m benchmarks.bench_serialization [--rows 500]
+"""
+
+import sys
+import json
+import time
+import argparse
+import importlib
+from pathlib import Path
+
+from pydantic import TypeAdapter
+
+root = Path(__file__).resolve().parents[1]
+
+ITERATIONS = 50
+
+
+def itinerary(rows):
+    file = {
+        "name": "Trip",
+        "id": "159YsZTIXvW5GbKNQnI9LSqPqmXhWoxIl_59YpisKrxM",
+        "kind": "drive#file",
+        "mimeType": "application/vnd.google-apps.spreadsheet",
+        "createdTime": "2024-11-22T15:29:44.226Z",
+        "modifiedTime": "2024-11-24T15:39:20.537Z",
+        "version": "12",
+    }
+    # rows as parse_rows returns them, every value a string
+    data = {
+        category: [
+            {
+                "index": index + 1,
+                "name": f"Stop {index}",
+                "location_1": "Red Rock Canyon State Park",
+                "location_2": "Nightmare Gulch",
+                "date_start": f"2024-{index % 12 + 1:02}-{index % 28 + 1:02}",
+                "date_end": f"2024-{index % 12 + 1:02}-{index % 28 + 1:02}",
+                "cost": str(index % 50),
+                **({"notes": "Bring water"} if index % 3 else {}),
+            }
+            for index in range(rows)
+        ]
+        for category in ["activities", "housing", "transportation"]
+    }
+    return file, data
+
+
+def bench(label, func):
+    body = func()  # warm up
+
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        func()
+    elapsed = (time.perf_counter() - start) / ITERATIONS
+
+    print(f"{label:<28} {elapsed * 1000:8.2f} ms {len(body) / 1024:10.1f} KiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=500, help="rows per category")
+    args = parser.parse_args()
+
+    # the project is a package, import it the way `fastapi dev main.py` does
+    sys.path.insert(0, str(root.parent))
+    models = importlib.import_module(f"{root.name}.routers.update_itineraries")
+    serialization = importlib.import_module(f"{root.name}.routers.serialization")
+
+    file, data = itinerary(args.rows)
+    adapter = TypeAdapter(models.Itinerary)
+
+    def response_model():
+        value = adapter.validate_python({**file, "data": data})
+        content = adapter.dump_python(value, mode="json", exclude_none=True)
+        return json.dumps(
+            content, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+        ).encode()
+
+    print(f"{3 * args.rows} rows, orjson {'on' if serialization.orjson else 'off'}")
+    print(f"{'path':<28} {'encode':>11} {'size':>14}")
+    bench("response model", response_model)
+    bench(
+        "fast path",
+        lambda: serialization.dumps(serialization.itinerary_payload(file, data)),
+    )
+    bench(
+        "columnar",
+        lambda: serialization.dumps(
+            serialization.itinerary_payload(file, data, columnar=True)
+        ),
+    )
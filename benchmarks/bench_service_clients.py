@@ -0,0 +1,50 @@
+"""Per-call overhead of building a Google API client vs checking one out of the pool.
+
+Run from the project root: python -m benchmarks.bench_service_clients
+"""
+
+import time
+
+from google.auth.credentials import AnonymousCredentials
+from googleapiclient.discovery import build
+
+from handlers.google_service import get_service
+
+ITERATIONS = 200
+
+
+def bench(label, func):
+    func()  # warm up
+
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        func()
+    elapsed = time.perf_counter() - start
+
+    print(f"{label:<28} {elapsed / ITERATIONS * 1e6:10.1f} us/call")
+    return elapsed
+
+
+def build_per_call(api, version):
+    def func():
+        with build(api, version, credentials=credentials) as service:
+            service.files() if api == "drive" else service.spreadsheets().values()
+
+    return func
+
+
+def pooled(api, version):
+    def func():
+        with get_service(credentials, api, version) as service:
+            service.files() if api == "drive" else service.spreadsheets().values()
+
+    return func
+
+
+credentials = AnonymousCredentials()
+
+if __name__ == "__main__":
+    for api, version in [("drive", "v3"), ("sheets", "v4")]:
+        before = bench(f"{api} build() per call", build_per_call(api, version))
+        after = bench(f"{api} pooled client", pooled(api, version))
+        print(f"{'speedup':<28} {before / after:10.1f}x\n")
@@ -0,0 +1,72 @@
+"""Cold-start time of the api, with and without cached file ids.
+
+Drive lookups are replaced with stubs that sleep for LATENCY seconds and the
+background token refresh is turned off, so no credentials are needed. Run from the project root:
+python -m benchmarks.bench_startup
+"""
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import importlib
+from pathlib import Path
+
+from benchmarks.fake_credentials import write_service_account_file
+
+LATENCY = 0.5
+
+root = Path(__file__).resolve().parents[1]
+directory = tempfile.mkdtemp()
+
+os.environ["SERVICE_ACCOUNT_FILE"] = os.path.join(directory, "credentials.json")
+os.environ["DISCOVERY_CACHE_FILE"] = os.path.join(directory, "discovery.json")
+write_service_account_file(os.environ["SERVICE_ACCOUNT_FILE"])
+
+
+def list_folders(credentials, parent=None):
+    time.sleep(LATENCY)
+    return [
+        {"name": name, "id": f"{name.lower()}-id"}
+        for name in ["Itineraries", "Archives", "Templates"]
+    ]
+
+
+def list_spreadsheets(credentials, parent=None):
+    time.sleep(LATENCY)
+    return [{"name": "Itinerary", "id": "template-id"}]
+
+
+async def no_refresh():
+    # the stubs need no access token, don't ask the token endpoint for one
+    await asyncio.Event().wait()
+
+
+async def startup(api):
+    start = time.perf_counter()
+    async with api.router.lifespan_context(api):
+        ready = time.perf_counter() - start
+        # let background revalidation finish before shutting down
+        await asyncio.sleep(LATENCY * 3)
+    return ready
+
+
+if __name__ == "__main__":
+    # the project is a package, import it the way `fastapi dev main.py` does
+    sys.path.insert(0, str(root.parent))
+
+    start = time.perf_counter()
+    api_module = importlib.import_module(f"{root.name}.api")
+    print(f"{'import api':<28} {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+    discovery = importlib.import_module(f"{root.name}.handlers.discovery")
+    discovery.list_folders = list_folders
+    discovery.list_spreadsheets = list_spreadsheets
+    api_module.credential_manager.run = no_refresh
+
+    ready = asyncio.run(startup(api_module.api))
+    print(f"{'startup, no cached ids':<28} {ready * 1000:8.1f} ms")
+
+    ready = asyncio.run(startup(api_module.api))
+    print(f"{'startup, cached ids':<28} {ready * 1000:8.1f} ms")
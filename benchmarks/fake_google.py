@@ -0,0 +1,576 @@
+"""Local stand-in for the parts of Drive v3 and Sheets v4 used by the handlers.
+
+Serves the OAuth token endpoint, Drive `files` (list/get/create/copy/update/
+delete), `permissions.create`, `changes` and batch requests, and Sheets
+`spreadsheets.get`/`batchUpdate` and
+`values.get/append/update/clear/batchGet/batchUpdate`.
+State is kept in memory. Every response can be delayed by `latency` seconds
+and fail with a 503/429 at `error_rate`/`rate_limit_rate`. `GET /_calls`
+returns the number of calls per method.
+
+python -m benchmarks.fake_google [--port 8765] [--latency 0.05]
+"""
+
+import re
+import json
+import time
+import uuid
+import random
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import Counter
+from http import HTTPStatus
+from email.parser import BytesParser
+from urllib.parse import urlsplit, parse_qs, unquote
+
+FOLDER = "application/vnd.google-apps.folder"
+SPREADSHEET = "application/vnd.google-apps.spreadsheet"
+# rows in a new sheet's grid
+GRID_ROWS = 1000
+
+COLUMNS = [
+    "name",
+    "itinerary",
+    "location_1",
+    "location_2",
+    "date_start",
+    "date_end",
+    "cost",
+    "notes",
+]
+
+A1_PATTERN = re.compile(r"^([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?$")
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")[:-6] + "Z"
+
+
+def parse_range(a1):
+    """Split an A1 range into (sheet title or None, first row, last row or None)."""
+    sheet, _, cells = a1.rpartition("!")
+
+    if not sheet and not A1_PATTERN.match(cells):
+        sheet, cells = cells, ""
+
+    if sheet.startswith("'") and sheet.endswith("'"):
+        sheet = sheet[1:-1].replace("''", "'")
+
+    match = A1_PATTERN.match(cells) if cells else None
+    if not match:
+        return sheet or None, 1, None
+
+    _, start, _, end = match.groups()
+    if start and end is None and ":" not in cells:
+        end = start
+    return sheet or None, int(start or 1), int(end) if end else None
+
+
+LITERALS = {"drive", "v3", "v4", "files", "copy", "permissions", "changes"}
+LITERALS |= {"startPageToken", "spreadsheets", "values", "token"}
+
+
+def route(part):
+    """Path segment with ids and ranges replaced, for counting calls per method."""
+    value, colon, verb = part.partition(":")
+    return (value if value in LITERALS else "{}") + colon + verb
+
+
+def trim(rows):
+    rows = [list(row) for row in rows]
+    for row in rows:
+        while row and row[-1] in ("", None):
+            row.pop()
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+
+class FakeGoogle:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+
+        self.files = {}
+        self.sheets = {}
+        self.changes = []
+        self.calls = Counter()
+        self.lock = threading.RLock()
+
+    # state
+
+    def _touch(self, file_id):
+        file = self.files[file_id]
+        file["modifiedTime"] = now()
+        file["version"] = str(int(file["version"]) + 1)
+        self.changes.append({"fileId": file_id, "file": dict(file)})
+
+    def add_file(self, name, mime_type, parents=(), id=None):
+        with self.lock:
+            id = id or uuid.uuid4().hex
+            self.files[id] = {
+                "kind": "drive#file",
+                "id": id,
+                "name": name,
+                "mimeType": mime_type,
+                "parents": list(parents),
+                "createdTime": now(),
+                "modifiedTime": now(),
+                "version": "1",
+                "trashed": False,
+            }
+            if mime_type == SPREADSHEET:
+                self.sheets[id] = {"Sheet1": {"sheetId": 0, "rows": []}}
+            self.changes.append({"fileId": id, "file": dict(self.files[id])})
+            return self.files[id]
+
+    def seed(self, itineraries=20, archives=5, rows=30):
+        """Create the folder layout, the template and some itineraries."""
+        root = self.add_file("Itineraries", FOLDER)["id"]
+        folders = {"Itineraries": root}
+        for name in ["Archives", "Templates"]:
+            folders[name] = self.add_file(name, FOLDER, [root])["id"]
+
+        template = self.add_file("Itinerary", SPREADSHEET, [folders["Templates"]])
+        self.sheets[template["id"]] = {
+            title: {"sheetId": index + 1, "rows": [list(COLUMNS)]}
+            for (index, title) in enumerate(["activities", "housing", "transportation"])
+        }
+
+        ids = {"Itineraries": [], "Archives": []}
+        for folder, count in [("Itineraries", itineraries), ("Archives", archives)]:
+            for n in range(count):
+                file = self.copy(template["id"], f"Trip {n}", [folders[folder]])
+                ids[folder].append(file["id"])
+                for sheet in self.sheets[file["id"]].values():
+                    sheet["rows"] += [
+                        [
+                            f"Stop {row}",
+                            "",
+                            "Red Rock Canyon State Park",
+                            "Nightmare Gulch",
+                            f"2024-{row % 12 + 1:02}-{row % 28 + 1:02}",
+                            f"2024-{row % 12 + 1:02}-{row % 28 + 1:02}",
+                            str(row % 50),
+                            "notes",
+                        ]
+                        for row in range(rows)
+                    ]
+
+        return {"folders": folders, "template_id": template["id"], **ids}
+
+    def copy(self, file_id, name, parents):
+        with self.lock:
+            source = self.files[file_id]
+            file = self.add_file(name or source["name"], source["mimeType"], parents)
+            self.sheets[file["id"]] = {
+                title: {"sheetId": sheet["sheetId"], "rows": trim(sheet["rows"])}
+                for (title, sheet) in self.sheets.get(file_id, {}).items()
+            }
+            return file
+
+    def _sheet(self, spreadsheet_id, title):
+        sheets = self.sheets[spreadsheet_id]
+        if title is None:
+            return next(iter(sheets.values()))
+        return sheets[title]
+
+    def _set_rows(self, sheet, start, values):
+        rows = sheet["rows"]
+        for offset, row in enumerate(values):
+            position = start - 1 + offset
+            while len(rows) <= position:
+                rows.append([])
+            current = rows[position]
+            for column, value in enumerate(row):
+                if value is None:
+                    continue  # null values leave cells unchanged
+                while len(current) <= column:
+                    current.append("")
+                current[column] = value
+
+    # drive
+
+    def drive(self, method, parts, query, body):
+        if parts == ["changes", "startPageToken"]:
+            return {"startPageToken": str(len(self.changes) + 1)}
+
+        if parts == ["changes"]:
+            start = int(query["pageToken"]) - 1
+            size = int(query.get("pageSize", 100))
+            changes = [
+                {"fileId": change["fileId"], "removed": change.get("removed", False)}
+                | ({"file": change["file"]} if "file" in change else {})
+                for change in self.changes[start : start + size]
+            ]
+            if start + size < len(self.changes):
+                return {"changes": changes, "nextPageToken": str(start + size + 1)}
+            return {"changes": changes, "newStartPageToken": str(len(self.changes) + 1)}
+
+        if parts == ["files"] and method == "GET":
+            files = [file for file in self.files.values() if not file["trashed"]]
+            for clause in (query.get("q") or "").split(" and "):
+                if clause.startswith("mimeType="):
+                    mime_type = clause.split("=", 1)[1].strip("'")
+                    files = [file for file in files if file["mimeType"] == mime_type]
+                elif clause.endswith(" in parents"):
+                    parent = clause.split()[0].strip("'")
+                    files = [file for file in files if parent in file["parents"]]
+
+            start = int(query.get("pageToken") or 0)
+            size = int(query.get("pageSize") or 100)
+            response = {"files": files[start : start + size]}
+            if start + size < len(files):
+                response["nextPageToken"] = str(start + size)
+            return response
+
+        if parts == ["files"] and method == "POST":
+            return self.add_file(body["name"], body["mimeType"], body.get("parents"))
+
+        file_id = parts[1]
+        if file_id not in self.files:
+            return 404, {"error": {"code": 404, "message": "File not found"}}
+
+        if parts[2:] == ["copy"]:
+            return self.copy(file_id, body.get("name"), body.get("parents") or [])
+
+        if parts[2:] == ["permissions"]:
+            return {"kind": "drive#permission", "id": uuid.uuid4().hex, **body}
+
+        file = self.files[file_id]
+
+        if method == "GET":
+            return file
+
+        if method == "PATCH":
+            file["parents"] = [
+                parent
+                for parent in file["parents"]
+                if parent not in (query.get("removeParents") or "").split(",")
+            ] + [
+                parent
+                for parent in (query.get("addParents") or "").split(",")
+                if parent
+            ]
+            file.update({key: value for (key, value) in (body or {}).items()})
+            self._touch(file_id)
+            return file
+
+        if method == "DELETE":
+            del self.files[file_id]
+            self.sheets.pop(file_id, None)
+            self.changes.append({"fileId": file_id, "removed": True})
+            return None
+
+    # sheets
+
+    def sheets_api(self, method, parts, query, body):
+        spreadsheet_id, _, action = parts[2].partition(":")
+        if spreadsheet_id not in self.sheets:
+            return 404, {"error": {"code": 404, "message": "Spreadsheet not found"}}
+
+        sheets = self.sheets[spreadsheet_id]
+
+        if len(parts) == 3 and not action:
+            return {
+                "spreadsheetId": spreadsheet_id,
+                "sheets": [
+                    {
+                        "properties": {
+                            "sheetId": sheet["sheetId"],
+                            "title": title,
+                            "gridProperties": {
+                                "rowCount": max(GRID_ROWS, len(sheet["rows"])),
+                                "columnCount": 26,
+                            },
+                        }
+                    }
+                    for (title, sheet) in sheets.items()
+                    if "ranges" not in query
+                    or {title, f"'{title}'"} & set(query["ranges"])
+                ],
+            }
+
+        if action == "batchUpdate":
+            for request in body["requests"]:
+                self._sheet_request(sheets, request)
+            self._touch(spreadsheet_id)
+            return {"spreadsheetId": spreadsheet_id, "replies": []}
+
+        values_action = parts[3].partition(":")[2] if len(parts) == 4 else ""
+
+        if len(parts) == 4 and values_action == "batchGet":
+            return {
+                "spreadsheetId": spreadsheet_id,
+                "valueRanges": [
+                    self._get(spreadsheet_id, range_name)
+                    for range_name in query.get("ranges", [])
+                ],
+            }
+
+        if len(parts) == 4 and values_action == "batchUpdate":
+            rows = 0
+            for data in body["data"]:
+                title, start, _ = parse_range(data["range"])
+                self._set_rows(
+                    self._sheet(spreadsheet_id, title), start, data["values"]
+                )
+                rows += len(data["values"])
+            self._touch(spreadsheet_id)
+            return {"spreadsheetId": spreadsheet_id, "totalUpdatedRows": rows}
+
+        # the range is percent-encoded, a literal `:` starts the custom verb
+        range_name, _, values_action = parts[4].partition(":")
+        range_name = unquote(range_name)
+        title, start, end = parse_range(range_name)
+
+        try:
+            sheet = self._sheet(spreadsheet_id, title)
+        except KeyError:
+            return 400, {"error": {"code": 400, "message": "Unable to parse range"}}
+
+        if method == "GET":
+            return self._get(spreadsheet_id, range_name)
+
+        if values_action == "append":
+            sheet["rows"] = trim(sheet["rows"])
+            sheet["rows"] += [list(row) for row in body["values"]]
+            self._touch(spreadsheet_id)
+            cells = sum(len(row) for row in body["values"])
+            return {
+                "updates": {"updatedRows": len(body["values"]), "updatedCells": cells}
+            }
+
+        if values_action == "clear":
+            for position in range(
+                start - 1, min(end or len(sheet["rows"]), len(sheet["rows"]))
+            ):
+                sheet["rows"][position] = []
+            self._touch(spreadsheet_id)
+            return {"clearedRange": range_name}
+
+        if method == "PUT":
+            self._set_rows(sheet, start, body["values"])
+            self._touch(spreadsheet_id)
+            return {"updatedRows": len(body["values"])}
+
+    def _get(self, spreadsheet_id, range_name):
+        title, start, end = parse_range(range_name)
+        try:
+            rows = self._sheet(spreadsheet_id, title)["rows"]
+        except KeyError:
+            return {"range": range_name, "majorDimension": "ROWS"}
+        values = trim(rows[start - 1 : end])
+        response = {"range": range_name, "majorDimension": "ROWS"}
+        if values:
+            response["values"] = values
+        return response
+
+    def _sheet_request(self, sheets, request):
+        by_id = {sheet["sheetId"]: sheet for sheet in sheets.values()}
+
+        if "deleteDimension" in request:
+            range = request["deleteDimension"]["range"]
+            del by_id[range["sheetId"]]["rows"][range["startIndex"] : range["endIndex"]]
+        elif "updateCells" in request:
+            start = request["updateCells"]["start"]
+            sheet = by_id[start["sheetId"]]
+            padding = [None] * start.get("columnIndex", 0)
+            self._set_rows(
+                sheet,
+                start.get("rowIndex", 0) + 1,
+                [
+                    padding
+                    + [
+                        str(next(iter(cell.get("userEnteredValue", {"": ""}).values())))
+                        for cell in row["values"]
+                    ]
+                    for row in request["updateCells"]["rows"]
+                ],
+            )
+        elif "appendCells" in request:
+            sheet = by_id[request["appendCells"]["sheetId"]]
+            sheet["rows"] = trim(sheet["rows"])
+            for row in request["appendCells"]["rows"]:
+                sheet["rows"].append(
+                    [
+                        str(next(iter(cell.get("userEnteredValue", {"": ""}).values())))
+                        for cell in row["values"]
+                    ]
+                )
+        elif "addSheet" in request:
+            properties = request["addSheet"]["properties"]
+            sheets[properties["title"]] = {
+                "sheetId": max(by_id, default=0) + 1,
+                "rows": [],
+            }
+        elif "deleteSheet" in request:
+            for title, sheet in list(sheets.items()):
+                if sheet["sheetId"] == request["deleteSheet"]["sheetId"]:
+                    del sheets[title]
+
+    # http
+
+    def handle(self, method, path, query, body):
+        parts = [part for part in path.split("/") if part]
+
+        if parts == ["_calls"]:
+            return None, 200, dict(self.calls)
+
+        if parts == ["token"]:
+            return (
+                "POST token",
+                200,
+                {
+                    "access_token": uuid.uuid4().hex,
+                    "expires_in": 3600,
+                    "token_type": "Bearer",
+                },
+            )
+
+        name = " ".join([method, "/".join(route(part) for part in parts)])
+
+        if parts[:2] == ["drive", "v3"]:
+            handler = self.drive
+            parts = parts[2:]
+        elif parts[:2] == ["v4", "spreadsheets"]:
+            handler = self.sheets_api
+        else:
+            return "unknown", 404, {"error": {"code": 404, "message": "Not found"}}
+
+        if random.random() < self.error_rate:
+            return name, 503, {"error": {"code": 503, "message": "Backend Error"}}
+        if random.random() < self.rate_limit_rate:
+            return name, 429, {"error": {"code": 429, "message": "Rate Limit Exceeded"}}
+
+        with self.lock:
+            try:
+                result = handler(method, parts, query, body)
+            except (KeyError, IndexError, ValueError) as error:
+                return name, 400, {"error": {"code": 400, "message": repr(error)}}
+
+        if isinstance(result, tuple):
+            return (name, *result)
+        return name, 200 if result is not None else 204, result
+
+    def batch(self, content_type, raw):
+        """Answer a multipart/mixed batch, return its content type and body."""
+        message = BytesParser().parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + raw
+        )
+        boundary = uuid.uuid4().hex
+        parts = []
+
+        for part in message.get_payload():
+            request = part.get_payload()
+            head, _, body = request.replace("\r\n", "\n").partition("\n\n")
+            method, target, _ = head.split("\n", 1)[0].split(" ", 2)
+            url = urlsplit(target)
+            query = {key: values[0] for (key, values) in parse_qs(url.query).items()}
+
+            _, status, response = self.handle(
+                method, url.path, query, json.loads(body) if body.strip() else None
+            )
+
+            content_id = part["Content-ID"].strip("<>")
+            content = json.dumps(response) if response is not None else ""
+            parts.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                "Content-Type: application/json\r\n\r\n"
+                f"{content}\r\n"
+            )
+
+        body = "".join(parts) + f"--{boundary}--\r\n"
+        return f"multipart/mixed; boundary={boundary}", body.encode()
+
+    def serve(self, host="127.0.0.1", port=0):
+        """Start serving on a background thread, return the server."""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body go out in separate writes, don't wait for acks
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                url = urlsplit(self.path)
+                query = {
+                    key: values if key == "ranges" else values[0]
+                    for (key, values) in parse_qs(url.query).items()
+                }
+                length = int(self.headers.get("content-length") or 0)
+                raw = self.rfile.read(length) if length else b""
+
+                if fake.latency or fake.jitter:
+                    time.sleep(fake.latency + random.uniform(0, fake.jitter))
+
+                if url.path.startswith("/batch/"):
+                    fake.calls[f"POST {url.path.strip('/')}"] += 1
+                    content_type, content = fake.batch(
+                        self.headers["content-type"], raw
+                    )
+                    self.send_response(200)
+                    self.send_header("content-type", content_type)
+                    self.send_header("content-length", str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+                    return
+
+                try:
+                    body = json.loads(raw) if raw else None
+                except ValueError:
+                    body = None
+
+                name, status, response = fake.handle(
+                    self.command, url.path, query, body
+                )
+                if name:
+                    fake.calls[name] += 1
+
+                content = json.dumps(response).encode() if response is not None else b""
+                self.send_response(status)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def run(options, seed, ready):
+    """Seed and serve in this process, send the seeded ids and port to `ready`."""
+    fake = FakeGoogle(**options)
+    seeded = fake.seed(**seed)
+    server = fake.serve()
+    ready.put({"port": server.server_port, **seeded})
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeGoogle(latency=args.latency, error_rate=args.error_rate)
+    print(json.dumps(fake.seed(), indent=2))
+    server = fake.serve(port=args.port)
+    print(f"Serving on http://127.0.0.1:{server.server_port}/")
+    threading.Event().wait()
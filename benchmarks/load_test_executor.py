@@ -0,0 +1,58 @@
+"""Concurrent-request throughput of async routes that block vs offload to the pool.
+
+Each request simulates one blocking Google API call. Run from the project root:
+python -m benchmarks.load_test_executor
+"""
+
+import time
+import asyncio
+
+import httpx
+from fastapi import FastAPI
+
+from handlers.executor import run_sync, set_threadpool_size
+
+UPSTREAM_LATENCY = 0.05
+REQUESTS = 200
+
+app = FastAPI()
+
+
+@app.get("/blocking")
+async def blocking():
+    time.sleep(UPSTREAM_LATENCY)
+
+
+@app.get("/offloaded")
+async def offloaded():
+    await run_sync(time.sleep, UPSTREAM_LATENCY)
+
+
+async def load(client, path, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call():
+        async with semaphore:
+            response = await client.get(path)
+            response.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[call() for _ in range(REQUESTS)])
+    return REQUESTS / (time.perf_counter() - start)
+
+
+async def main():
+    transport = httpx.ASGITransport(app=app)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        rate = await load(client, "/blocking", concurrency=50)
+        print(f"{'blocking':<24} {rate:8.1f} req/s")
+
+        for size in [1, 5, 10, 25, 50]:
+            set_threadpool_size(size)
+            rate = await load(client, "/offloaded", concurrency=50)
+            print(f"{f'offloaded, {size} threads':<24} {rate:8.1f} req/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,67 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from .google_drive import list_folders, list_spreadsheets
+
+FOLDER_NAMES = ["Itineraries", "Archives", "Templates"]
+TEMPLATE_NAME = "Itinerary"
+
+
+def discover(credentials, templates_id=None):
+    """Find the folder and template file ids.
+
+    With a known `Templates` folder id (e.g. from the cache file), the folder
+    and template lookups run in parallel.
+    """
+    if templates_id:
+        with ThreadPoolExecutor(2) as executor:
+            folders = executor.submit(list_folders, credentials)
+            templates = executor.submit(list_spreadsheets, credentials, templates_id)
+            folders, templates = folders.result(), templates.result()
+    else:
+        folders, templates = list_folders(credentials), None
+
+    if folders is None:
+        raise ConnectionError("Could not list folders")
+
+    folders = dict([[folder["name"], folder["id"]] for folder in folders])
+
+    for name in FOLDER_NAMES:
+        if name not in folders:
+            raise FileNotFoundError(f"Could not find `{name}` folder")
+
+    # other folders (e.g. `Staging`) shouldn't make the cached ids look stale
+    folders = {name: folders[name] for name in FOLDER_NAMES}
+
+    # the cached folder was moved or replaced, look again in the current one
+    if templates is None or folders["Templates"] != templates_id:
+        templates = list_spreadsheets(credentials, folders["Templates"])
+
+    template = [file for file in templates or [] if file["name"] == TEMPLATE_NAME]
+
+    if not template:
+        raise FileNotFoundError("Could not find template itinerary")
+
+    return {"folders": folders, "template_id": template[0]["id"]}
+
+
+def load_discovery(path, account):
+    try:
+        with open(path) as file:
+            cached = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    # ids found by another service account are of no use
+    if cached.get("account") != account:
+        return None
+
+    return {"folders": cached["folders"], "template_id": cached["template_id"]}
+
+
+def save_discovery(path, account, discovery):
+    try:
+        with open(path, "w") as file:
+            json.dump({"account": account, **discovery}, file, indent=2)
+    except OSError as error:
+        print(f"An error occurred saving {path}: {error}")
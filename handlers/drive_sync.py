@@ -0,0 +1,170 @@
+import time
+import asyncio
+import threading
+
+from .executor import run_sync
+from .google_drive import (
+    SPREADSHEET,
+    list_spreadsheets,
+    get_start_page_token,
+    list_changes,
+)
+
+
+class FolderIndex:
+    """In-memory index of the spreadsheets in a set of Drive folders.
+
+    Seeded from one full listing per folder, then kept current by applying
+    deltas from the Drive Changes API. Callers should only trust the index
+    while `is_fresh()`, i.e. it has synced within `max_staleness` seconds.
+    """
+
+    counters = ("syncs", "changes", "errors")
+
+    def __init__(self, credentials, folder_ids, interval=10, max_staleness=60):
+        self.credentials = credentials
+        self.folder_ids = set(folder_ids)
+        self.interval = interval
+        self.max_staleness = max_staleness
+
+        self._files = {folder_id: {} for folder_id in self.folder_ids}
+        self._parents = {}
+        self._lock = threading.Lock()
+
+        self.page_token = None
+        self.last_sync = None
+        self.syncs = 0
+        self.changes = 0
+        self.errors = 0
+
+    def seed(self):
+        # take the token first, so changes made during the listing are replayed
+        page_token = get_start_page_token(self.credentials)
+        listings = {
+            folder_id: list_spreadsheets(self.credentials, parent=folder_id)
+            for folder_id in self.folder_ids
+        }
+
+        if any(files is None for files in listings.values()):
+            raise RuntimeError("Could not list folders")
+
+        with self._lock:
+            self._files = {
+                folder_id: {file["id"]: file for file in files}
+                for (folder_id, files) in listings.items()
+            }
+            self._parents = {
+                file["id"]: folder_id
+                for (folder_id, files) in listings.items()
+                for file in files
+            }
+            self.page_token = page_token
+            self.last_sync = time.monotonic()
+
+        print(f"Indexed {len(self._parents)} files in {len(listings)} folders.")
+
+    def sync(self):
+        page_token = self.page_token
+
+        while True:
+            response = list_changes(self.credentials, page_token)
+
+            for change in response.get("changes", []):
+                self.apply(change)
+
+            if "newStartPageToken" in response:
+                page_token = response["newStartPageToken"]
+                break
+            page_token = response["nextPageToken"]
+
+        with self._lock:
+            self.page_token = page_token
+            self.last_sync = time.monotonic()
+            self.syncs += 1
+
+    def apply(self, change):
+        file = change.get("file") or {}
+        folder_id = None
+
+        if not change.get("removed") and not file.get("trashed"):
+            if file.get("mimeType") == SPREADSHEET:
+                folder_id = next(
+                    (id for id in file.get("parents", []) if id in self.folder_ids),
+                    None,
+                )
+
+        file = {
+            key: value
+            for (key, value) in file.items()
+            if key not in ("parents", "trashed")
+        }
+
+        with self._lock:
+            self.changes += 1
+            self._remove(change["fileId"])
+            if folder_id:
+                self._files[folder_id][change["fileId"]] = file
+                self._parents[change["fileId"]] = folder_id
+
+    def _remove(self, file_id):
+        folder_id = self._parents.pop(file_id, None)
+        if folder_id:
+            self._files[folder_id].pop(file_id, None)
+
+    def upsert(self, file, folder_id):
+        """Record a change made through this service without waiting for a sync."""
+        with self._lock:
+            current = self._files.get(self._parents.get(file["id"]), {})
+            file = {**current.get(file["id"], {}), **file}
+            self._remove(file["id"])
+            self._files[folder_id][file["id"]] = file
+            self._parents[file["id"]] = folder_id
+
+    def remove(self, file_id):
+        with self._lock:
+            self._remove(file_id)
+
+    def is_fresh(self):
+        return (
+            self.last_sync is not None
+            and time.monotonic() - self.last_sync <= self.max_staleness
+        )
+
+    def list(self, folder_id):
+        with self._lock:
+            return list(self._files[folder_id].values())
+
+    def file(self, file_id):
+        with self._lock:
+            return self._files.get(self._parents.get(file_id), {}).get(file_id)
+
+    def parent(self, file_id):
+        with self._lock:
+            return self._parents.get(file_id)
+
+    async def run(self):
+        while True:
+            try:
+                if self.page_token is None:
+                    await run_sync(self.seed)
+                else:
+                    await run_sync(self.sync)
+            except Exception as error:
+                self.errors += 1
+                print(f"An error occurred syncing folders: {error}")
+
+            await asyncio.sleep(self.interval)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "files": len(self._parents),
+                "fresh": self.is_fresh(),
+                "sync_lag_seconds": (
+                    time.monotonic() - self.last_sync if self.last_sync else None
+                ),
+                "max_staleness_seconds": self.max_staleness,
+                "syncs": self.syncs,
+                "changes": self.changes,
+                "errors": self.errors,
+            }
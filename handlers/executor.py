@@ -0,0 +1,30 @@
+import os
+from functools import partial
+
+import anyio.to_thread
+from anyio import CapacityLimiter
+
+from .google_service import POOL_SIZE
+
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE") or POOL_SIZE)
+
+_limiter = None
+
+
+def get_limiter():
+    # limiters bind to the running event loop, so create on first use
+    global _limiter
+    if _limiter is None:
+        _limiter = CapacityLimiter(THREADPOOL_SIZE)
+    return _limiter
+
+
+def set_threadpool_size(size):
+    get_limiter().total_tokens = size
+
+
+async def run_sync(func, *args, **kwargs):
+    """Run a blocking handler in the bounded worker thread pool."""
+    return await anyio.to_thread.run_sync(
+        partial(func, *args, **kwargs), limiter=get_limiter()
+    )
@@ -1,5 +1,22 @@
+import os
+import json
+import asyncio
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import httplib2
+from google_auth_httplib2 import Request
 from google.oauth2 import service_account
 
+from .executor import run_sync
+
+try:
+    import fcntl
+except ImportError:  # not on windows, workers then share the file unlocked
+    fcntl = None
+
 SCOPES = ["https://www.googleapis.com/auth/drive"]
 
 
@@ -14,3 +31,143 @@ def get_credentials(service_account_file=None, service_account_info=None):
         )
 
     return credentials
+
+
+def utcnow():
+    # google-auth keeps expiry as a naive utc datetime
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class CredentialManager:
+    """Refreshes the access token of shared credentials ahead of its expiry.
+
+    The token is refreshed in the background `margin` seconds before it
+    expires, so requests don't wait on the token endpoint. A request that
+    does find the token expired, or rejected, waits for the one refresh in
+    progress instead of starting its own. With a `token_file`, worker
+    processes share the token: the first to refresh writes it, the others
+    read it.
+    """
+
+    counters = ("refreshes", "loaded", "errors")
+
+    def __init__(self, credentials, token_file=None, margin=300, retry_interval=10):
+        self.credentials = credentials
+        self.token_file = token_file
+        self.margin = margin
+        self.retry_interval = retry_interval
+
+        self._refresh_token = credentials.refresh
+        self._lock = threading.Lock()
+        self._http = httplib2.Http(timeout=30)
+
+        # refreshes started by clients go through the lock as well
+        credentials.refresh = self._refresh_inline
+
+        self.refreshes = 0
+        self.loaded = 0
+        self.errors = 0
+
+    def expires_in(self):
+        if not self.credentials.token or self.credentials.expiry is None:
+            return 0
+        return (self.credentials.expiry - utcnow()).total_seconds()
+
+    def _usable(self, stale):
+        return self.credentials.token != stale and self.expires_in() > self.margin
+
+    def _refresh_inline(self, request):
+        self.refresh(request, stale=self.credentials.token)
+
+    def refresh(self, request=None, stale=None):
+        """Get a new token unless the current one is good past the margin.
+
+        `stale` is a token the API rejected, it is replaced even if it
+        hasn't expired.
+        """
+        with self._lock:
+            if self._usable(stale):
+                return
+
+            with self._file_lock():
+                # another worker may have refreshed already
+                if self._load() and self._usable(stale):
+                    return
+
+                self._refresh_token(request or Request(self._http))
+                self.refreshes += 1
+                self._save()
+
+    @contextmanager
+    def _file_lock(self):
+        if not (self.token_file and fcntl):
+            yield
+            return
+
+        with open(f"{self.token_file}.lock", "a") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def _load(self):
+        if not self.token_file:
+            return False
+
+        try:
+            with open(self.token_file) as file:
+                shared = json.load(file)
+            expiry = datetime.fromisoformat(shared["expiry"])
+        except (OSError, ValueError, KeyError):
+            return False
+
+        if shared.get("account") != self.credentials.service_account_email:
+            return False
+        if self.credentials.expiry and expiry <= self.credentials.expiry:
+            return False
+
+        self.credentials.token = shared["token"]
+        self.credentials.expiry = expiry
+        self.loaded += 1
+        return True
+
+    def _save(self):
+        if not self.token_file:
+            return
+
+        shared = {
+            "account": self.credentials.service_account_email,
+            "token": self.credentials.token,
+            "expiry": self.credentials.expiry.isoformat(),
+        }
+        # write a private temporary file, then swap it in whole
+        directory = os.path.dirname(os.path.abspath(self.token_file))
+        fd, path = tempfile.mkstemp(dir=directory, prefix=".token-")
+        try:
+            with os.fdopen(fd, "w") as file:
+                json.dump(shared, file)
+            os.replace(path, self.token_file)
+        except OSError as error:
+            print(f"Could not save the shared token: {error}")
+            os.unlink(path)
+
+    async def run(self):
+        while True:
+            try:
+                await run_sync(self.refresh)
+                delay = max(self.expires_in() - self.margin, self.retry_interval)
+            except Exception as error:
+                self.errors += 1
+                print(f"An error occurred refreshing credentials: {error}")
+                delay = self.retry_interval
+
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            "expires_in": max(self.expires_in(), 0),
+            "refreshes": self.refreshes,
+            "loaded": self.loaded,
+            "errors": self.errors,
+        }
@@ -1,10 +1,25 @@
-from googleapiclient.discovery import build
+import os
+import time
+
 from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
+
+from . import metrics
+from .google_service import get_service, get_batch_uri
+from .scheduler import scheduler, is_retryable
+
+FOLDER = "application/vnd.google-apps.folder"
+SPREADSHEET = "application/vnd.google-apps.spreadsheet"
+
+FILE_FIELDS = "id, name, kind, mimeType, createdTime, modifiedTime, version"
+PAGE_SIZE = int(os.getenv("DRIVE_PAGE_SIZE") or 100)
+# drive accepts up to 100 requests per batch
+BATCH_SIZE = 100
 
 
 def create_file(credentials, name, mime_type, parent=None):
-    # create drive api client
-    with build("drive", "v3", credentials=credentials) as service:
+    # check out pooled drive api client
+    with get_service(credentials, "drive", "v3") as service:
         try:
             file_metadata = {
                 "name": name,
@@ -23,25 +38,27 @@ def create_file(credentials, name, mime_type, parent=None):
 
 
 def create_folder(credentials, name, parent=None):
-    return create_file(credentials, name, "application/vnd.google-apps.folder", parent)
+    return create_file(credentials, name, FOLDER, parent)
 
 
 def create_spreadsheet(credentials, name, parent=None):
-    return create_file(
-        credentials, name, "application/vnd.google-apps.spreadsheet", parent
-    )
+    return create_file(credentials, name, SPREADSHEET, parent)
 
 
-def copy_file(credentials, file_id, name, parent_id=None):
-    # create drive api client
-    with build("drive", "v3", credentials=credentials) as service:
+def copy_file(credentials, file_id, name, parent_id=None, fields=FILE_FIELDS):
+    # check out pooled drive api client
+    with get_service(credentials, "drive", "v3") as service:
         try:
             file_metadata = {
                 "name": name,
                 "parents": [parent_id],
             }
 
-            file = service.files().copy(body=file_metadata, fileId=file_id).execute()
+            file = (
+                service.files()
+                .copy(body=file_metadata, fileId=file_id, fields=fields)
+                .execute()
+            )
             print(f'Created file ID at "{parent_id}": "{file.get("id")}".')
             return file
 
@@ -50,12 +67,21 @@ def copy_file(credentials, file_id, name, parent_id=None):
             return None
 
 
-def move_file(credentials, file_id, parent_id):
-    # create drive api client
-    with build("drive", "v3", credentials=credentials) as service:
+def move_file(
+    credentials, file_id, parent_id, remove_parent_id=None, fields=FILE_FIELDS
+):
+    # check out pooled drive api client
+    with get_service(credentials, "drive", "v3") as service:
         try:
             file = (
-                service.files().update(addParents=parent_id, fileId=file_id).execute()
+                service.files()
+                .update(
+                    addParents=parent_id,
+                    removeParents=remove_parent_id,
+                    fileId=file_id,
+                    fields=fields,
+                )
+                .execute()
             )
             print(f'Moved file ID to "{parent_id}": "{file.get("id")}".')
             return file
@@ -65,55 +91,118 @@ def move_file(credentials, file_id, parent_id):
             return None
 
 
-def list_files(credentials, mime_type=None, parent=None):
-    # create drive api client
-    with build("drive", "v3", credentials=credentials) as service:
-        q = ""
-        q += f"mimeType='{mime_type}'" if mime_type else ""
-        q += f" and '{parent}' in parents" if parent else ""
+def update_file(
+    credentials,
+    file_id,
+    name=None,
+    add_parent_id=None,
+    remove_parent_id=None,
+    fields=FILE_FIELDS,
+):
+    # rename and/or move in a single request
+    with get_service(credentials, "drive", "v3") as service:
+        try:
+            file = (
+                service.files()
+                .update(
+                    fileId=file_id,
+                    body={"name": name} if name else {},
+                    addParents=add_parent_id,
+                    removeParents=remove_parent_id,
+                    fields=fields,
+                )
+                .execute()
+            )
+            print(f'Updated file ID: "{file.get("id")}".')
+            return file
+
+        except HttpError as error:
+            print(f"An error occurred: {error}")
+            return None
+
+
+def list_files_page(
+    credentials,
+    mime_type=None,
+    parent=None,
+    page_size=PAGE_SIZE,
+    page_token=None,
+    fields=FILE_FIELDS,
+):
+    # check out pooled drive api client
+    with get_service(credentials, "drive", "v3") as service:
+        q = []
+        q += [f"mimeType='{mime_type}'"] if mime_type else []
+        q += [f"'{parent}' in parents"] if parent else []
 
         try:
             response = (
                 service.files()
                 .list(
-                    q=q,
-                    fields="files(id, name, kind, mimeType, createdTime, modifiedTime)",
+                    q=" and ".join(q),
+                    pageSize=page_size,
+                    pageToken=page_token,
+                    fields=f"nextPageToken, files({fields})",
                 )
                 .execute()
             )
-            return response.get("files")
+            return {
+                "files": response.get("files", []),
+                "nextPageToken": response.get("nextPageToken"),
+            }
         except HttpError as error:
             print(f"An error occurred: {error}")
             return None
 
 
+def iter_pages(credentials, mime_type=None, parent=None, page_token=None, **kwargs):
+    # yields each page of a listing, or None if a page could not be fetched
+    while True:
+        page = list_files_page(
+            credentials, mime_type, parent, page_token=page_token, **kwargs
+        )
+        yield page
+
+        page_token = page and page["nextPageToken"]
+        if not page_token:
+            return
+
+
+def list_files(credentials, mime_type=None, parent=None, **kwargs):
+    files = []
+
+    for page in iter_pages(credentials, mime_type, parent, **kwargs):
+        if page is None:
+            return None
+        files += page["files"]
+
+    return files
+
+
 def list_folders(credentials, parent=None):
-    return list_files(
-        credentials, mime_type="application/vnd.google-apps.folder", parent=parent
-    )
+    return list_files(credentials, mime_type=FOLDER, parent=parent)
 
 
 def list_spreadsheets(credentials, parent=None):
-    return list_files(
-        credentials, mime_type="application/vnd.google-apps.spreadsheet", parent=parent
-    )
+    return list_files(credentials, mime_type=SPREADSHEET, parent=parent)
+
+
+def get_file(credentials, file_id, fields=FILE_FIELDS):
+    with get_service(credentials, "drive", "v3") as service:
+        response = service.files().get(fileId=file_id, fields=fields).execute()
 
-def get_file(credentials, file_id):
-    with build("drive", "v3", credentials=credentials) as service:
-        response = service.files().get(fileId=file_id).execute()
-    
     return response
 
 
 def get_parent_ids(credentials, file_id):
-    with build("drive", "v3", credentials=credentials) as service:
+    with get_service(credentials, "drive", "v3") as service:
         response = service.files().get(fileId=file_id, fields="parents").execute()
 
     return response
 
 
 def delete_file(credentials, file_id):
-    with build("drive", "v3", credentials=credentials) as service:
+    with get_service(credentials, "drive", "v3") as service:
         try:
             file = service.files().delete(fileId=file_id).execute()
             return file
@@ -125,8 +214,143 @@ def delete_file(credentials, file_id):
 def share_file(credentials, file_id, email_address, role="reader"):
     user_permission = {"type": "user", "role": role, "emailAddress": email_address}
 
-    with build("drive", "v3", credentials=credentials) as service:
+    with get_service(credentials, "drive", "v3") as service:
         response = (
             service.permissions().create(fileId=file_id, body=user_permission).execute()
         )
         return response
+
+
+def get_start_page_token(credentials):
+    with get_service(credentials, "drive", "v3") as service:
+        response = service.changes().getStartPageToken().execute()
+
+    return response["startPageToken"]
+
+
+def list_changes(credentials, page_token, fields=FILE_FIELDS):
+    with get_service(credentials, "drive", "v3") as service:
+        response = (
+            service.changes()
+            .list(
+                pageToken=page_token,
+                pageSize=1000,
+                spaces="drive",
+                includeRemoved=True,
+                fields=(
+                    "nextPageToken, newStartPageToken, "
+                    f"changes(fileId, removed, file({fields}, parents, trashed))"
+                ),
+            )
+            .execute()
+        )
+
+    return response
+
+
+def batch_execute(credentials, make_request, items, kind="write"):
+    """Run `make_request(service, item)` for every item in Drive batch requests.
+
+    Returns one `(response, error)` pair per item, in order. Requests failing
+    with rate limiting or server errors are retried in a later batch, so they
+    must leave the same result when repeated, as gets, moves and deletes do.
+    """
+    results = [None] * len(items)
+    pending = list(range(len(items)))
+    attempt = 0
+
+    with get_service(credentials, "drive", "v3") as service:
+        while pending:
+            retry = []
+
+            for start in range(0, len(pending), BATCH_SIZE):
+                chunk = pending[start : start + BATCH_SIZE]
+
+                def callback(request_id, response, error):
+                    position = int(request_id)
+                    if (
+                        error
+                        and is_retryable(error)
+                        and attempt < scheduler.max_retries
+                    ):
+                        retry.append(position)
+                    else:
+                        results[position] = (response, error)
+
+                batch = BatchHttpRequest(
+                    callback=callback, batch_uri=get_batch_uri("drive", "v3")
+                )
+                for position in chunk:
+                    batch.add(
+                        make_request(service, items[position]),
+                        request_id=str(position),
+                    )
+
+                try:
+                    execute_batch(batch, kind, len(chunk))
+                except HttpError as error:
+                    print(f"An error occurred: {error}")
+                    for position in chunk:
+                        results[position] = (None, error)
+
+            if retry:
+                time.sleep(scheduler.backoff(attempt, None))
+                attempt += 1
+            pending = sorted(retry)
+
+    return results
+
+
+def execute_batch(batch, kind, size):
+    if not metrics.ENABLED:
+        return scheduler.run(("drive", kind), None, batch.execute, tokens=size)
+
+    def call():
+        status = "error"
+        start = time.perf_counter()
+        try:
+            batch.execute()
+            status = 200
+        except HttpError as error:
+            status = error.resp.status
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            metrics.record("drive.batch", status, seconds, 0, None)
+
+    return scheduler.run(("drive", kind), None, call, tokens=size)
+
+
+def batch_get_files(credentials, file_ids, fields=FILE_FIELDS):
+    return batch_execute(
+        credentials,
+        lambda service, file_id: service.files().get(fileId=file_id, fields=fields),
+        file_ids,
+        kind="read",
+    )
+
+
+def batch_get_parents(credentials, file_ids):
+    """Parent folder ids of each file, or the error getting them."""
+    return batch_get_files(credentials, file_ids, fields="id, parents")
+
+
+def batch_move_files(credentials, file_ids, parent_id, remove_parent_id):
+    return batch_execute(
+        credentials,
+        lambda service, file_id: service.files().update(
+            fileId=file_id,
+            addParents=parent_id,
+            removeParents=remove_parent_id,
+            fields=FILE_FIELDS,
+        ),
+        file_ids,
+    )
+
+
+def batch_delete_files(credentials, file_ids):
+    return batch_execute(
+        credentials,
+        lambda service, file_id: service.files().delete(fileId=file_id),
+        file_ids,
+    )
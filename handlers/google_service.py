@@ -0,0 +1,152 @@
+import os
+import json
+import queue
+import threading
+from contextlib import contextmanager
+from functools import cache
+from urllib.parse import urljoin
+
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document, fix_method_name
+from googleapiclient.discovery_cache import get_static_doc
+
+from .scheduler import ScheduledHttpRequest
+
+POOL_SIZE = int(os.getenv("GOOGLE_API_POOL_SIZE") or 10)
+HTTP_TIMEOUT = float(os.getenv("GOOGLE_API_TIMEOUT") or 60)
+# point the clients at a stand-in server, e.g. benchmarks/fake_google.py
+API_ENDPOINT = os.getenv("GOOGLE_API_ENDPOINT")
+
+
+@cache
+def get_discovery_document(api, version):
+    # discovery documents are bundled with googleapiclient, parse each one once
+    document = get_static_doc(api, version)
+
+    if document is None:
+        raise ValueError(f"No discovery document for {api} {version}")
+
+    return json.loads(document)
+
+
+def get_batch_uri(api, version):
+    document = get_discovery_document(api, version)
+    # batch requests aren't sent to the client's endpoint
+    root = API_ENDPOINT or document["rootUrl"]
+    return urljoin(root, document.get("batchPath", "batch"))
+
+
+class Resources:
+    """A service or resource whose nested resources are built once.
+
+    googleapiclient builds a new resource, with all of its methods, on every
+    call like `service.spreadsheets()`. The built one is kept and returned
+    from then on; everything else is looked up on the wrapped resource.
+    """
+
+    def __init__(self, resource):
+        self._resource = resource
+        self._nested = {
+            fix_method_name(name)
+            for name in resource._resourceDesc.get("resources", {})
+        }
+
+    def __getattr__(self, name):
+        if name not in self._nested:
+            return getattr(self._resource, name)
+
+        resource = Resources(getattr(self._resource, name)())
+        # later lookups find the built resource without coming back here
+        setattr(self, name, lambda: resource)
+        return getattr(self, name)
+
+
+class ServicePool:
+    """Reusable API clients for one set of credentials.
+
+    googleapiclient services (and the underlying httplib2 connections) are not
+    thread-safe, so each client is checked out by one thread at a time. Idle
+    clients keep their connections open, and the resources built from them,
+    for the next checkout.
+    """
+
+    def __init__(self, credentials, api, version, max_size=POOL_SIZE):
+        self.credentials = credentials
+        self.api = api
+        self.version = version
+        self.max_size = max_size
+
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self.created = 0
+
+    def _build(self):
+        http = AuthorizedHttp(
+            self.credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT)
+        )
+        document = get_discovery_document(self.api, self.version)
+        # the endpoint replaces the whole base url, keep the api's own path
+        client_options = (
+            {"api_endpoint": urljoin(API_ENDPOINT, document["servicePath"])}
+            if API_ENDPOINT
+            else None
+        )
+        # requests made through the client go through the shared scheduler
+        service = build_from_document(
+            document,
+            http=http,
+            requestBuilder=ScheduledHttpRequest,
+            client_options=client_options,
+        )
+        self.created += 1
+        return Resources(service)
+
+    @contextmanager
+    def checkout(self):
+        self._slots.acquire()
+        try:
+            try:
+                service = self._idle.get_nowait()
+            except queue.Empty:
+                service = self._build()
+
+            try:
+                yield service
+            finally:
+                self._idle.put(service)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                service = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            service.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(credentials, api, version):
+    key = (credentials, api, version)
+
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ServicePool(credentials, api, version)
+        return _pools[key]
+
+
+def get_service(credentials, api, version):
+    """Check out a pooled client, use as `with get_service(...) as service:`."""
+    return get_pool(credentials, api, version).checkout()
+
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
@@ -1,10 +1,129 @@
-from googleapiclient.discovery import build
+import os
+import time
+import threading
+
 from googleapiclient.errors import HttpError
 from fastapi import HTTPException
 
+from .google_service import get_service
+
+SCHEMA_TTL = float(os.getenv("SHEET_SCHEMA_TTL") or 600)
+# rows per read when a sheet is read in windows
+CHUNK_ROWS = int(os.getenv("SHEETS_CHUNK_ROWS") or 500)
+
+# layout of the sheets created by bootstrap_spreadsheet
+SHEET_NAMES = ["activities", "housing", "transportation"]
+COLUMNS = [
+    "name",
+    "itinerary",
+    "location_1",
+    "location_2",
+    "date_start",
+    "date_end",
+    "cost",
+    "notes",
+]
+
+
+def a1_sheet(sheet_name):
+    escaped = sheet_name.replace("'", "''")
+    return f"'{escaped}'"
+
+
+def fetch_schema(service, spreadsheet_id):
+    # sheet ids, grid sizes and header rows, two field-masked reads
+    response = (
+        service.spreadsheets()
+        .get(
+            spreadsheetId=spreadsheet_id,
+            fields="sheets.properties(sheetId,title,gridProperties.rowCount)",
+        )
+        .execute()
+    )
+    sheet_ids = {
+        sheet["properties"]["title"]: sheet["properties"]["sheetId"]
+        for sheet in response.get("sheets", [])
+    }
+    row_counts = {
+        sheet["properties"]["title"]: sheet["properties"]
+        .get("gridProperties", {})
+        .get("rowCount", 0)
+        for sheet in response.get("sheets", [])
+    }
+
+    result = (
+        service.spreadsheets()
+        .values()
+        .batchGet(
+            spreadsheetId=spreadsheet_id,
+            ranges=[f"{a1_sheet(title)}!1:1" for title in sheet_ids],
+            fields="valueRanges(values)",
+        )
+        .execute()
+    )
+    headers = {
+        title: (value_range.get("values") or [[]])[0]
+        for (title, value_range) in zip(sheet_ids, result.get("valueRanges", []))
+    }
+
+    return {"sheet_ids": sheet_ids, "headers": headers, "row_counts": row_counts}
+
+
+class SchemaCache:
+    """Header columns, title -> sheetId map and grid sizes for each spreadsheet.
+
+    Writes reuse the cached schema instead of reading the header row (or the
+    whole spreadsheet) first. A write that fails against a cached schema is
+    retried once against a freshly fetched one.
+    """
+
+    def __init__(self, ttl=SCHEMA_TTL):
+        self.ttl = ttl
+        self._schemas = {}
+        self._lock = threading.Lock()
+
+    def get(self, service, spreadsheet_id):
+        with self._lock:
+            entry = self._schemas.get(spreadsheet_id)
+
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+
+        schema = fetch_schema(service, spreadsheet_id)
+
+        with self._lock:
+            self._schemas[spreadsheet_id] = (time.monotonic() + self.ttl, schema)
+
+        return schema
+
+    def invalidate(self, spreadsheet_id):
+        with self._lock:
+            self._schemas.pop(spreadsheet_id, None)
+
+    def write(self, service, spreadsheet_id, write):
+        """Call `write(schema)`, refreshing the schema once if it is out of date."""
+        with self._lock:
+            cached = spreadsheet_id in self._schemas
+
+        schema = self.get(service, spreadsheet_id)
+
+        try:
+            return write(schema)
+        except (KeyError, HttpError) as error:
+            mismatch = isinstance(error, KeyError) or error.resp.status == 400
+            if not (cached and mismatch):
+                raise
+
+        print(f"Schema mismatch, refreshing schema for {spreadsheet_id}")
+        self.invalidate(spreadsheet_id)
+        return write(self.get(service, spreadsheet_id))
+
+
+schema_cache = SchemaCache()
+
 
 def bootstrap_spreadsheet(credentials, spreadsheet_id):
-    with build("sheets", "v4", credentials=credentials) as service:
+    with get_service(credentials, "sheets", "v4") as service:
         try:
             # create sheets
             requests = [
@@ -20,33 +139,40 @@ def bootstrap_spreadsheet(credentials, spreadsheet_id):
             ).execute()
 
             # add headers to each sheet
-            columns = [
-                "name",
-                "itinerary",
-                "location_1",
-                "location_2",
-                "date_start",
-                "date_end",
-                "cost",
-                "notes",
-            ]
-            sheet_names = ["activities", "transportation", "housing"]
-
-            for sheet in sheet_names:
+            for sheet in SHEET_NAMES:
                 service.spreadsheets().values().append(
                     spreadsheetId=spreadsheet_id,
                     range=sheet,
                     valueInputOption="RAW",
-                    body={"values": [columns]},
+                    body={"values": [COLUMNS]},
                 ).execute()
 
+            schema_cache.invalidate(spreadsheet_id)
+
         except HttpError as error:
             print(f"An error occurred: {error}")
             return error
 
 
+def parse_rows(rows):
+    # map each row onto the header row, index is the row's position below the header
+    if not rows:
+        return []
+
+    header = rows[0]
+    data = rows[1:]
+
+    return [
+        {
+            "index": index + 1,
+            **dict([key, value] for (key, value) in zip(header, row) if value),
+        }
+        for (index, row) in enumerate(data)
+    ]
+
+
 def get_spreadsheet_data(credentials, spreadsheet_id, range_name):
-    with build("sheets", "v4", credentials=credentials) as service:
+    with get_service(credentials, "sheets", "v4") as service:
         try:
             result = (
                 service.spreadsheets()
@@ -57,38 +183,167 @@ def get_spreadsheet_data(credentials, spreadsheet_id, range_name):
             rows = result.get("values", [])
             print(f"{len(rows)} rows retrieved")
 
-            header = rows[0]
-            data = rows[1:]
-
-            return [
-                {
-                    "index": index + 1,
-                    **dict([key, value] for (key, value) in zip(header, row) if value),
-                }
-                for (index, row) in enumerate(data)
-            ]
+            return parse_rows(rows)
 
         except HttpError as error:
             print(f"An error occurred: {error}")
             raise HTTPException(status_code=error.resp.status)
 
 
-def append_sheet(credentials, spreadsheet_id, sheet_name, data):
-    with build("sheets", "v4", credentials=credentials) as service:
+def window_range(sheet_name, start, chunk_rows):
+    return f"{a1_sheet(sheet_name)}!A{start}:Z{start + chunk_rows - 1}"
+
+
+def parse_window(header, rows, start):
+    # sheet row `n` is row index `n - 1`, the header being row 1
+    return [
+        {
+            "index": start - 1 + offset,
+            **dict([key, value] for (key, value) in zip(header, row) if value),
+        }
+        for (offset, row) in enumerate(rows)
+    ]
+
+
+def iter_row_chunks(
+    credentials,
+    spreadsheet_id,
+    sheet_name,
+    chunk_rows=CHUNK_ROWS,
+    first=None,
+    row_count=None,
+):
+    """Rows of a sheet, read and yielded `chunk_rows` rows at a time.
+
+    Rows are numbered by their position in the sheet, as `parse_rows` does,
+    so their `index` is the one `update_row` and `delete_row` expect. Sheets
+    leaves blank rows off the end of each window, so a short window does not
+    mean the data has ended: every window up to the sheet's `rowCount` is
+    read. The row count comes from the cached schema unless given. Past it,
+    in case the sheet grew since, windows are read while they come back
+    full. `first` holds the values of the first window when they were already
+    read. A client is checked out of the pool for each read only.
+    """
+    header = None
+    start = 1
+    rows = first
+
+    try:
+        if row_count is None:
+            with get_service(credentials, "sheets", "v4") as service:
+                row_count = schema_cache.get(service, spreadsheet_id)["row_counts"][
+                    sheet_name
+                ]
+
+        while True:
+            if rows is None:
+                with get_service(credentials, "sheets", "v4") as service:
+                    result = (
+                        service.spreadsheets()
+                        .values()
+                        .get(
+                            spreadsheetId=spreadsheet_id,
+                            range=window_range(sheet_name, start, chunk_rows),
+                        )
+                        .execute()
+                    )
+                rows = result.get("values", [])
+
+            if header is None:
+                header = (rows or [[]])[0]
+                yield parse_window(header, rows[1:], start + 1)
+            else:
+                yield parse_window(header, rows, start)
+
+            if start + chunk_rows > row_count and len(rows) < chunk_rows:
+                return
+            start += chunk_rows
+            rows = None
+
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"No sheet `{sheet_name}`")
+    except HttpError as error:
+        print(f"An error occurred: {error}")
+        raise HTTPException(status_code=error.resp.status)
+
+
+def iter_itinerary_chunks(
+    credentials, spreadsheet_id, sheet_names=SHEET_NAMES, chunk_rows=CHUNK_ROWS
+):
+    """(sheet name, rows) for each window of each sheet, one sheet after another.
+
+    The first window of every sheet is read in one batchGet, the later ones
+    sheet by sheet, up to each sheet's cached row count.
+    """
+    with get_service(credentials, "sheets", "v4") as service:
+        try:
+            row_counts = schema_cache.get(service, spreadsheet_id)["row_counts"]
+            result = (
+                service.spreadsheets()
+                .values()
+                .batchGet(
+                    spreadsheetId=spreadsheet_id,
+                    ranges=[
+                        window_range(sheet_name, 1, chunk_rows)
+                        for sheet_name in sheet_names
+                    ],
+                )
+                .execute()
+            )
+        except HttpError as error:
+            print(f"An error occurred: {error}")
+            raise HTTPException(status_code=error.resp.status)
+
+    # value ranges are returned in the order requested
+    for sheet_name, value_range in zip(sheet_names, result.get("valueRanges", [])):
+        first = value_range.get("values", [])
+        for rows in iter_row_chunks(
+            credentials,
+            spreadsheet_id,
+            sheet_name,
+            chunk_rows,
+            first,
+            row_counts.get(sheet_name, 0),
+        ):
+            yield sheet_name, rows
+
+
+def batch_get_spreadsheet_data(credentials, spreadsheet_id, range_names):
+    with get_service(credentials, "sheets", "v4") as service:
         try:
             result = (
                 service.spreadsheets()
                 .values()
-                .get(spreadsheetId=spreadsheet_id, range=f"{sheet_name}!1:1")
+                .batchGet(spreadsheetId=spreadsheet_id, ranges=range_names)
                 .execute()
             )
+            value_ranges = result.get("valueRanges", [])
+            rows = sum(
+                len(value_range.get("values", [])) for value_range in value_ranges
+            )
+            print(f"{rows} rows retrieved from {len(value_ranges)} ranges")
 
-            header = result.get("values", [])[0]
+            # value ranges are returned in the order requested
+            return {
+                range_name: parse_rows(value_range.get("values", []))
+                for (range_name, value_range) in zip(range_names, value_ranges)
+            }
+
+        except HttpError as error:
+            print(f"An error occurred: {error}")
+            raise HTTPException(status_code=error.resp.status)
+
+
+def append_sheet(credentials, spreadsheet_id, sheet_name, data):
+    with get_service(credentials, "sheets", "v4") as service:
+
+        def append(schema):
+            header = schema["headers"][sheet_name]
             body = {
                 "values": [[row.get(field, None) for field in header] for row in data]
             }
 
-            result = (
+            return (
                 service.spreadsheets()
                 .values()
                 .append(
@@ -100,30 +355,29 @@ def append_sheet(credentials, spreadsheet_id, sheet_name, data):
                 .execute()
             )
 
+        try:
+            result = schema_cache.write(service, spreadsheet_id, append)
+
             print(f"{(result.get('updates').get('updatedCells'))} cells appended.")
             return result
 
+        except KeyError:
+            raise HTTPException(status_code=404, detail=f"No sheet `{sheet_name}`")
         except HttpError as error:
             print(f"An error occurred: {error}")
             raise HTTPException(status_code=error.resp.status)
 
 
 def update_row(credentials, spreadsheet_id, sheet_name, index, data):
-    with build("sheets", "v4", credentials=credentials) as service:
-        try:
-            result = (
-                service.spreadsheets()
-                .values()
-                .get(spreadsheetId=spreadsheet_id, range=f"{sheet_name}!1:1")
-                .execute()
-            )
+    with get_service(credentials, "sheets", "v4") as service:
 
-            header = result.get("values", [])[0]
+        def update(schema):
+            header = schema["headers"][sheet_name]
             body = {"values": [[data.get(field, None) for field in header]]}
 
             range = f"{sheet_name}!{index + 1}:{index + 1}"
 
-            result = (
+            return (
                 service.spreadsheets()
                 .values()
                 .update(
@@ -135,27 +389,24 @@ def update_row(credentials, spreadsheet_id, sheet_name, index, data):
                 .execute()
             )
 
+        try:
+            result = schema_cache.write(service, spreadsheet_id, update)
+
             print(f"{(result.get('updatedRows'))} rows updated.")
             return result
 
+        except KeyError:
+            raise HTTPException(status_code=404, detail=f"No sheet `{sheet_name}`")
         except HttpError as error:
             print(f"An error occurred: {error}")
             raise HTTPException(status_code=error.resp.status)
 
 
 def delete_row(credentials, spreadsheet_id, sheet_name, index):
-    with build("sheets", "v4", credentials=credentials) as service:
-        try:
-            # Retrieve sheet id
-            request = service.spreadsheets().get(spreadsheetId=spreadsheet_id)
-            response = request.execute()
+    with get_service(credentials, "sheets", "v4") as service:
 
-            sheets = response["sheets"]
-            sheet_id = [
-                sheet["properties"]["sheetId"]
-                for sheet in sheets
-                if sheet["properties"]["title"] == sheet_name
-            ][0]
+        def delete(schema):
+            sheet_id = schema["sheet_ids"][sheet_name]
 
             # Delete dimension
             request_body = {
@@ -173,15 +424,20 @@ def delete_row(credentials, spreadsheet_id, sheet_name, index):
                 ]
             }
 
-            result = (
+            return (
                 service.spreadsheets()
                 .batchUpdate(spreadsheetId=spreadsheet_id, body=request_body)
                 .execute()
             )
 
+        try:
+            result = schema_cache.write(service, spreadsheet_id, delete)
+
             print(f"Deleted rows.")
             return result
 
+        except KeyError:
+            raise HTTPException(status_code=404, detail=f"No sheet `{sheet_name}`")
         except HttpError as error:
             print(f"An error occurred: {error}")
             raise HTTPException(status_code=error.resp.status)
@@ -190,7 +446,7 @@ def delete_row(credentials, spreadsheet_id, sheet_name, index):
 def clear_sheet(credentials, spreadsheet_id, sheet_name):
     range_name = f"{sheet_name}!A2:Z"
 
-    with build("sheets", "v4", credentials=credentials) as service:
+    with get_service(credentials, "sheets", "v4") as service:
         try:
             response = (
                 service.spreadsheets()
@@ -202,3 +458,140 @@ def clear_sheet(credentials, spreadsheet_id, sheet_name):
         except HttpError as error:
             print(f"An error occurred: {error}")
             return error
+
+
+def cell_data(value):
+    # mirror valueInputOption=RAW for cells written through spreadsheets.batchUpdate
+    if value is None:
+        return {}
+    if isinstance(value, bool):
+        return {"userEnteredValue": {"boolValue": value}}
+    if isinstance(value, (int, float)):
+        return {"userEnteredValue": {"numberValue": value}}
+    return {"userEnteredValue": {"stringValue": str(value)}}
+
+
+def update_cells(sheet_id, index, values):
+    """updateCells requests writing `values` into row `index`.
+
+    Like values.update, None leaves a cell unchanged: each run of other
+    values is written by its own request.
+    """
+    requests = []
+    start = None
+
+    for column, value in enumerate([*values, None]):
+        if value is not None and start is None:
+            start = column
+        elif value is None and start is not None:
+            requests.append(
+                {
+                    "updateCells": {
+                        "start": {
+                            "sheetId": sheet_id,
+                            "rowIndex": index,
+                            "columnIndex": start,
+                        },
+                        "rows": [
+                            {"values": [cell_data(v) for v in values[start:column]]}
+                        ],
+                        "fields": "userEnteredValue",
+                    }
+                }
+            )
+            start = None
+
+    return requests
+
+
+def batch_update_sheets(credentials, spreadsheet_id, operations):
+    """Apply create/update/delete operations in one atomic round-trip.
+
+    Each operation is a dict with `op`, `sheet_name`, and `index` and/or `data`.
+    Indexes refer to rows as they were before the batch: one
+    spreadsheets.batchUpdate writes updated rows, then deletes rows bottom-up
+    per sheet and appends new rows. Sheets applies all of it or none of it.
+    """
+    results = [
+        {"op": operation["op"], "sheet_name": operation["sheet_name"], "status": "ok"}
+        for operation in operations
+    ]
+
+    with get_service(credentials, "sheets", "v4") as service:
+        try:
+            schema = schema_cache.get(service, spreadsheet_id)
+
+            updates = []
+            deletes = {}
+            appends = {}
+
+            for operation, result in zip(operations, results):
+                op = operation["op"]
+                sheet_name = operation["sheet_name"]
+                index = operation.get("index")
+                data = operation.get("data")
+                result["index"] = index
+
+                if sheet_name not in schema["sheet_ids"]:
+                    result.update(status="error", detail=f"No sheet `{sheet_name}`")
+                elif op in ("update", "delete") and (index is None or index < 1):
+                    result.update(status="error", detail="Row index must be >= 1")
+                elif op in ("create", "update") and data is None:
+                    result.update(status="error", detail="Missing data")
+                elif op == "delete" and index in deletes.get(sheet_name, {}):
+                    result.update(status="error", detail="Row already deleted")
+                elif op == "delete":
+                    deletes.setdefault(sheet_name, {})[index] = result
+                elif op == "update":
+                    header = schema["headers"][sheet_name]
+                    updates += update_cells(
+                        schema["sheet_ids"][sheet_name],
+                        index,
+                        [data.get(field, None) for field in header],
+                    )
+                elif op == "create":
+                    header = schema["headers"][sheet_name]
+                    appends.setdefault(sheet_name, []).append(
+                        {"values": [cell_data(data.get(field)) for field in header]}
+                    )
+                else:
+                    result.update(status="error", detail=f"Unknown op `{op}`")
+
+            # delete from the bottom up so pending indexes stay valid
+            requests = updates + [
+                {
+                    "deleteDimension": {
+                        "range": {
+                            "sheetId": schema["sheet_ids"][sheet_name],
+                            "dimension": "ROWS",
+                            "startIndex": index,
+                            "endIndex": index + 1,
+                        }
+                    }
+                }
+                for (sheet_name, indexes) in deletes.items()
+                for index in sorted(indexes, reverse=True)
+            ]
+            requests += [
+                {
+                    "appendCells": {
+                        "sheetId": schema["sheet_ids"][sheet_name],
+                        "rows": rows,
+                        "fields": "userEnteredValue",
+                    }
+                }
+                for (sheet_name, rows) in appends.items()
+            ]
+
+            if requests:
+                service.spreadsheets().batchUpdate(
+                    spreadsheetId=spreadsheet_id, body={"requests": requests}
+                ).execute()
+                print(f"{len(requests)} sheet requests applied.")
+
+            return results
+
+        except HttpError as error:
+            print(f"An error occurred: {error}")
+            schema_cache.invalidate(spreadsheet_id)
+            raise HTTPException(status_code=error.resp.status)
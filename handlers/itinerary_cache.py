@@ -0,0 +1,94 @@
+import time
+import threading
+from collections import OrderedDict
+
+from .row_index import RowIndex
+
+
+class ItineraryCache:
+    """In-process LRU cache of parsed itinerary data.
+
+    Entries are keyed by spreadsheet id and only returned while the Drive
+    `modifiedTime` they were read at is still current and their TTL has not
+    expired. One entry is kept per spreadsheet, along with the row indexes
+    built over it for queries.
+    """
+
+    counters = ("hits", "misses", "evictions")
+
+    def __init__(self, max_size=128, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, spreadsheet_id):
+        with self._lock:
+            return spreadsheet_id in self._entries
+
+    def get(self, spreadsheet_id, modified_time):
+        with self._lock:
+            entry = self._entries.get(spreadsheet_id)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            entry_modified_time, expires, data, _ = entry
+
+            if entry_modified_time != modified_time or expires < time.monotonic():
+                del self._entries[spreadsheet_id]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(spreadsheet_id)
+            self.hits += 1
+            return data
+
+    def set(self, spreadsheet_id, modified_time, data):
+        with self._lock:
+            self._entries[spreadsheet_id] = (
+                modified_time,
+                time.monotonic() + self.ttl,
+                data,
+                {},
+            )
+            self._entries.move_to_end(spreadsheet_id)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def index(self, spreadsheet_id, modified_time, category):
+        """Row index of a cached category, built on first use."""
+        with self._lock:
+            entry = self._entries.get(spreadsheet_id)
+
+            if entry is None or entry[0] != modified_time:
+                return None
+
+            _, _, data, indexes = entry
+
+            if category not in indexes and category in data:
+                indexes[category] = RowIndex(data[category])
+
+            return indexes.get(category)
+
+    def invalidate(self, spreadsheet_id):
+        with self._lock:
+            self._entries.pop(spreadsheet_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
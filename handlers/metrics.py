@@ -0,0 +1,243 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+
+from googleapiclient.errors import HttpError
+
+ENABLED = (os.getenv("METRICS_ENABLED") or "").lower() in ("1", "true", "yes")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CALL_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 32)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        # prometheus buckets are inclusive upper bounds
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Registry:
+    """Counters and histograms, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, value=1):
+        with self._lock:
+            self.counters[name, labels] += value
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        with self._lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[name, labels] = Histogram(buckets)
+            histogram.observe(value)
+
+    def render(self, gauges=(), counters=()):
+        lines = []
+
+        with self._lock:
+            for name, samples in group([*self.counters.items(), *counters]).items():
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in samples:
+                    lines.append(f"{name}{format_labels(labels)} {value:g}")
+
+            for name, samples in group(self.histograms.items()).items():
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in samples:
+                    total = 0
+                    for bound, count in zip(
+                        [*histogram.buckets, "+Inf"], histogram.counts
+                    ):
+                        total += count
+                        bucket_labels = format_labels((*labels, ("le", bound)))
+                        lines.append(f"{name}_bucket{bucket_labels} {total}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum:g}")
+                    lines.append(f"{name}_count{format_labels(labels)} {total}")
+
+        for name, samples in group(gauges).items():
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{format_labels(labels)} {value:g}")
+
+        return "\n".join(lines) + "\n"
+
+
+def group(samples):
+    grouped = defaultdict(list)
+    for (name, labels), value in sorted(samples, key=lambda sample: sample[0]):
+        grouped[name].append((labels, value))
+    return grouped
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for (key, value) in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for (key, value) in escaped) + "}"
+
+
+def stats_samples(prefix, stats, counters=()):
+    """Flatten a `stats()` dict into gauge and counter samples.
+
+    Nested dicts become labels. The stats named in `counters` only ever grow,
+    they're named with a `_total` suffix.
+    """
+    gauges, totals = [], []
+
+    for name, value in stats.items():
+        if name in counters:
+            samples, metric = totals, f"{prefix}_{name}_total"
+        else:
+            samples, metric = gauges, f"{prefix}_{name}"
+
+        if isinstance(value, dict):
+            samples += [
+                ((metric, (("key", key),)), item) for (key, item) in value.items()
+            ]
+        elif value is not None:
+            samples.append(((metric, ()), float(value)))
+
+    return gauges, totals
+
+
+registry = Registry()
+
+
+class Upstream:
+    """Google API calls made while handling one inbound request."""
+
+    __slots__ = ("calls", "seconds")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+
+
+# set per inbound request, worker threads see it through the copied context
+upstream = ContextVar("upstream", default=None)
+
+
+def instrument(request, call):
+    """Wrap an attempt at a googleapiclient request so each try is recorded."""
+    method = request.methodId or "unknown"
+    attempts = 0
+    response = {}
+
+    postproc = request.postproc
+
+    def measured_postproc(resp, content):
+        response["status"] = resp.status
+        response["bytes"] = len(content or b"")
+        return postproc(resp, content)
+
+    request.postproc = measured_postproc
+
+    def attempt():
+        nonlocal attempts
+        attempts += 1
+        if attempts > 1:
+            registry.inc("google_api_retries_total", (("method", method),))
+
+        response.clear()
+        status = "error"
+        start = time.perf_counter()
+        try:
+            result = call()
+            status = response.get("status", 200)
+            return result
+        except HttpError as error:
+            status = error.resp.status
+            response["bytes"] = len(error.content or b"")
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            sent = len(request.body or "")
+            record(method, status, seconds, sent, response.get("bytes"))
+
+    return attempt
+
+
+def record(method, status, seconds, sent, received):
+    labels = (("method", method),)
+
+    registry.inc("google_api_requests_total", (*labels, ("status", str(status))))
+    registry.observe("google_api_request_duration_seconds", labels, seconds)
+    registry.inc("google_api_sent_bytes_total", labels, sent)
+    if received is not None:
+        registry.inc("google_api_received_bytes_total", labels, received)
+
+    usage = upstream.get()
+    if usage is not None:
+        usage.calls += 1
+        usage.seconds += seconds
+
+
+def route_template(scope):
+    template = scope["route"].path
+    # newer fastapi versions leave the prefix of an included router off its
+    # routes, take the segments the template doesn't cover from the path
+    segments = scope["path"].removeprefix(scope.get("root_path", "")).split("/")
+    prefix = "/".join(segments[: len(segments) - template.count("/")])
+    return template if template.startswith(prefix) else prefix + template
+
+
+async def upstream_middleware(request, call_next):
+    """Count the Google API calls and time spent on them per inbound request."""
+    usage = Upstream()
+    token = upstream.set(usage)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        upstream.reset(token)
+
+    route = route_template(request.scope) if "route" in request.scope else "unmatched"
+
+    response.headers["X-Upstream-Calls"] = str(usage.calls)
+    response.headers["Server-Timing"] = f"upstream;dur={usage.seconds * 1000:.1f}"
+
+    def observe():
+        labels = (("route", route),)
+        registry.inc(
+            "http_requests_total",
+            (
+                *labels,
+                ("method", request.method),
+                ("status", str(response.status_code)),
+            ),
+        )
+        registry.observe(
+            "http_request_duration_seconds", labels, time.perf_counter() - start
+        )
+        registry.observe(
+            "http_request_upstream_calls", labels, usage.calls, CALL_BUCKETS
+        )
+        registry.observe("http_request_upstream_seconds", labels, usage.seconds)
+
+    # streamed bodies keep calling upstream after the headers are sent
+    body = response.body_iterator
+
+    async def observed_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            observe()
+
+    response.body_iterator = observed_body()
+    return response
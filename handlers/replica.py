@@ -0,0 +1,236 @@
+import json
+import time
+import asyncio
+import sqlite3
+import threading
+
+from .executor import run_sync
+from .google_drive import list_spreadsheets
+from .google_sheets import SHEET_NAMES, COLUMNS, batch_get_spreadsheet_data
+
+
+class Replica:
+    """Local SQLite copy of the rows of every itinerary in a set of folders.
+
+    One table holds the Drive metadata of each itinerary, another holds every
+    row of its sheets using the column layout from `bootstrap_spreadsheet`.
+    Itineraries are re-read only when their Drive `modifiedTime` changes.
+    """
+
+    counters = ("syncs", "errors")
+
+    def __init__(self, path, credentials, folder_ids, interval=300, folder_index=None):
+        self.path = path
+        self.credentials = credentials
+        self.folder_ids = list(folder_ids)
+        self.interval = interval
+        self.folder_index = folder_index
+
+        self._local = threading.local()
+
+        self.last_sync = None
+        self.syncs = 0
+        self.errors = 0
+
+        columns = ", ".join(
+            f"{column} {'NUMERIC' if column == 'cost' else 'TEXT'}"
+            for column in COLUMNS
+        )
+
+        with self._connection() as connection:
+            connection.executescript(f"""
+                CREATE TABLE IF NOT EXISTS itineraries (
+                    id TEXT PRIMARY KEY,
+                    folder_id TEXT,
+                    modified_time TEXT,
+                    file TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS rows (
+                    itinerary_id TEXT NOT NULL,
+                    category TEXT NOT NULL,
+                    row_index INTEGER NOT NULL,
+                    {columns},
+                    PRIMARY KEY (itinerary_id, category, row_index)
+                );
+                CREATE INDEX IF NOT EXISTS rows_category ON rows (category);
+                CREATE INDEX IF NOT EXISTS rows_date_start ON rows (date_start);
+                """)
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads, keep one per thread
+        connection = getattr(self._local, "connection", None)
+
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.row_factory = sqlite3.Row
+            self._local.connection = connection
+
+        return connection
+
+    def store(self, file, data, folder_id=None):
+        rows = [
+            (
+                file["id"],
+                category,
+                row["index"],
+                *[row.get(column) for column in COLUMNS],
+            )
+            for (category, category_rows) in data.items()
+            for row in category_rows
+        ]
+
+        with self._connection() as connection:
+            connection.execute("DELETE FROM rows WHERE itinerary_id = ?", (file["id"],))
+            connection.executemany(
+                f"INSERT INTO rows VALUES ({', '.join('?' * (3 + len(COLUMNS)))})",
+                rows,
+            )
+            connection.execute(
+                """
+                INSERT INTO itineraries (id, folder_id, modified_time, file)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    folder_id = coalesce(excluded.folder_id, folder_id),
+                    modified_time = excluded.modified_time,
+                    file = excluded.file
+                """,
+                (file["id"], folder_id, file.get("modifiedTime"), json.dumps(file)),
+            )
+
+    def remove(self, file_id):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM rows WHERE itinerary_id = ?", (file_id,))
+            connection.execute("DELETE FROM itineraries WHERE id = ?", (file_id,))
+
+    def invalidate(self, file_id):
+        """Mark an itinerary as written to, until it is stored again."""
+        with self._connection() as connection:
+            connection.execute(
+                """
+                INSERT INTO itineraries (id, modified_time, file)
+                VALUES (?, NULL, 'null')
+                ON CONFLICT (id) DO UPDATE SET modified_time = NULL
+                """,
+                (file_id,),
+            )
+
+    def file(self, file_id):
+        """Drive metadata of an itinerary, False if it was written to since, or None."""
+        itinerary = (
+            self._connection()
+            .execute(
+                "SELECT modified_time, file FROM itineraries WHERE id = ?", (file_id,)
+            )
+            .fetchone()
+        )
+
+        if itinerary is None:
+            return None
+        if itinerary["modified_time"] is None:
+            return False
+        return json.loads(itinerary["file"])
+
+    def get(self, file_id, modified_time=None, categories=SHEET_NAMES):
+        """Rows of an itinerary, or None if it isn't replicated at `modified_time`."""
+        connection = self._connection()
+
+        itinerary = connection.execute(
+            "SELECT modified_time FROM itineraries WHERE id = ?", (file_id,)
+        ).fetchone()
+
+        if itinerary is None or (
+            modified_time and itinerary["modified_time"] != modified_time
+        ):
+            return None
+
+        data = {category: [] for category in categories}
+        placeholders = ", ".join("?" * len(categories))
+
+        for row in connection.execute(
+            f"""
+            SELECT * FROM rows
+            WHERE itinerary_id = ? AND category IN ({placeholders})
+            ORDER BY category, row_index
+            """,
+            (file_id, *categories),
+        ):
+            data[row["category"]].append(
+                {
+                    "index": row["row_index"],
+                    **{
+                        column: row[column]
+                        for column in COLUMNS
+                        if row[column] is not None
+                    },
+                }
+            )
+
+        return data
+
+    def sync(self):
+        if self.folder_index and self.folder_index.is_fresh():
+            listings = {
+                folder_id: self.folder_index.list(folder_id)
+                for folder_id in self.folder_ids
+            }
+        else:
+            listings = {
+                folder_id: list_spreadsheets(self.credentials, parent=folder_id)
+                for folder_id in self.folder_ids
+            }
+
+        if any(files is None for files in listings.values()):
+            raise RuntimeError("Could not list folders")
+
+        connection = self._connection()
+        replicated = dict(
+            connection.execute("SELECT id, modified_time FROM itineraries").fetchall()
+        )
+        current = set()
+
+        for folder_id, files in listings.items():
+            for file in files:
+                current.add(file["id"])
+
+                if replicated.get(file["id"]) == file.get("modifiedTime"):
+                    continue
+
+                try:
+                    data = batch_get_spreadsheet_data(
+                        self.credentials, file["id"], SHEET_NAMES
+                    )
+                    self.store(file, data, folder_id)
+                except Exception as error:
+                    self.errors += 1
+                    print(f"An error occurred replicating {file['id']}: {error}")
+
+        for file_id in replicated.keys() - current:
+            self.remove(file_id)
+
+        self.last_sync = time.monotonic()
+        self.syncs += 1
+
+    async def run(self):
+        while True:
+            try:
+                await run_sync(self.sync)
+            except Exception as error:
+                self.errors += 1
+                print(f"An error occurred syncing the replica: {error}")
+
+            await asyncio.sleep(self.interval)
+
+    def stats(self):
+        connection = self._connection()
+        return {
+            "itineraries": connection.execute(
+                "SELECT count(*) FROM itineraries"
+            ).fetchone()[0],
+            "rows": connection.execute("SELECT count(*) FROM rows").fetchone()[0],
+            "sync_lag_seconds": (
+                time.monotonic() - self.last_sync if self.last_sync else None
+            ),
+            "syncs": self.syncs,
+            "errors": self.errors,
+        }
@@ -0,0 +1,107 @@
+from bisect import bisect_left, bisect_right
+
+SORT_FIELDS = ["index", "name", "date_start", "date_end", "cost"]
+
+
+def date_key(row, field):
+    # dates are written as ISO strings, compare the date part only
+    value = row.get(field)
+    return str(value)[:10] if value else None
+
+
+def cost_key(row):
+    try:
+        return float(row["cost"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def overlaps(row, date_from=None, date_to=None):
+    """Whether the row's dates overlap [date_from, date_to], as `between` matches."""
+    start = date_key(row, "date_start")
+    if start is None:
+        return date_from is None and date_to is None
+
+    end = date_key(row, "date_end") or start
+    return (date_from is None or end >= date_from) and (
+        date_to is None or start <= date_to
+    )
+
+
+class RowIndex:
+    """Rows of one category sheet, sorted by `date_start` for range lookups.
+
+    Alongside the start dates it keeps the running maximum of the end dates,
+    which is non-decreasing, so both ends of a date range can be bisected.
+    Rows without a `date_start` are kept apart and never match a date range.
+    """
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+
+        dated = [row for row in self.rows if date_key(row, "date_start")]
+        dated.sort(key=lambda row: date_key(row, "date_start"))
+
+        self.dated = dated
+        self.starts = [date_key(row, "date_start") for row in dated]
+        self.ends = [
+            date_key(row, "date_end") or start
+            for (row, start) in zip(dated, self.starts)
+        ]
+
+        self.max_ends = []
+        for end in self.ends:
+            self.max_ends.append(max(end, self.max_ends[-1]) if self.max_ends else end)
+
+    def between(self, date_from=None, date_to=None):
+        """Rows whose dates overlap [date_from, date_to], either end optional."""
+        if date_from is None and date_to is None:
+            return self.rows
+
+        # nothing before `first` ends on or after date_from
+        first = bisect_left(self.max_ends, date_from) if date_from else 0
+        last = bisect_right(self.starts, date_to) if date_to else len(self.dated)
+
+        return [
+            row
+            for (row, end) in zip(self.dated[first:last], self.ends[first:last])
+            if date_from is None or end >= date_from
+        ]
+
+    def query(
+        self,
+        date_from=None,
+        date_to=None,
+        cost_min=None,
+        cost_max=None,
+        sort="index",
+        descending=False,
+        offset=0,
+        limit=None,
+    ):
+        rows = self.between(
+            date_from and date_from.isoformat(), date_to and date_to.isoformat()
+        )
+
+        if cost_min is not None or cost_max is not None:
+            rows = [
+                row
+                for row in rows
+                if (cost := cost_key(row)) is not None
+                and (cost_min is None or cost >= cost_min)
+                and (cost_max is None or cost <= cost_max)
+            ]
+
+        if sort == "cost":
+            key = cost_key
+        elif sort in ("date_start", "date_end"):
+            key = lambda row: date_key(row, sort)
+        else:
+            key = lambda row: row.get(sort)
+
+        # rows missing the sort field go last in either direction
+        present = [row for row in rows if key(row) is not None]
+        missing = [row for row in rows if key(row) is None]
+        rows = sorted(present, key=key, reverse=descending) + missing
+
+        return rows[offset : offset + limit if limit else None]
@@ -0,0 +1,233 @@
+import os
+import re
+import time
+import random
+import threading
+from collections import Counter
+
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+
+from . import metrics
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+FILE_ID_PATTERN = re.compile(r"/(?:spreadsheets|files)/([^/:?]+)")
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at `rate_per_minute`."""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity or max(1, rate_per_minute // 6)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` are available, return the time spent waiting."""
+        # more than the capacity would never be available at once
+        tokens = min(tokens, self.capacity)
+        waited = 0
+
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                delay = (tokens - self.tokens) / self.rate
+
+            time.sleep(delay)
+            waited += delay
+
+
+def is_rate_limited(error):
+    if error.resp.status == 429:
+        return True
+    # drive reports rate limiting as 403
+    return error.resp.status == 403 and b"ratelimitexceeded" in (
+        error.content or b""
+    ).lower().replace(b"_", b"")
+
+
+def is_retryable(error, idempotent=True):
+    """Whether the request may be sent again after `error`.
+
+    A write may have been applied when the server errors or the response is
+    lost, so writes are only retried when they were rejected for rate limits.
+    """
+    if isinstance(error, HttpError):
+        if is_rate_limited(error):
+            return True
+        return idempotent and error.resp.status in RETRY_STATUSES
+
+    return idempotent and isinstance(error, (TimeoutError, ConnectionError))
+
+
+class Scheduler:
+    """Paces, limits and retries every Drive/Sheets request.
+
+    Requests take a token from the bucket for their API and kind (read or
+    write), wait for a slot if their spreadsheet already has
+    `max_per_spreadsheet` requests in flight, and are retried with jittered
+    exponential backoff on rate limiting, and reads also on server errors.
+    `limits` maps each API and kind to a rate, or to a bucket it shares.
+    """
+
+    counters = ("requests", "retries", "failures", "throttled_seconds")
+
+    def __init__(
+        self,
+        limits,
+        max_per_spreadsheet=4,
+        max_retries=5,
+        base_delay=0.5,
+        max_delay=32,
+    ):
+        # keys sharing one quota are given the same bucket
+        self.buckets = {
+            key: rate if isinstance(rate, TokenBucket) else TokenBucket(rate)
+            for (key, rate) in limits.items()
+        }
+        self.max_per_spreadsheet = max_per_spreadsheet
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._active = Counter()
+        self._slots = threading.Condition()
+        self._lock = threading.Lock()
+
+        self.waiting = 0
+        self.in_flight = 0
+        self.requests = Counter()
+        self.retries = Counter()
+        self.failures = Counter()
+        self.throttled_seconds = 0.0
+
+    def _acquire_slot(self, file_id):
+        with self._slots:
+            while self._active[file_id] >= self.max_per_spreadsheet:
+                self._slots.wait()
+            self._active[file_id] += 1
+
+    def _release_slot(self, file_id):
+        with self._slots:
+            self._active[file_id] -= 1
+            if not self._active[file_id]:
+                del self._active[file_id]
+            self._slots.notify_all()
+
+    def _add(self, name, value):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def _count(self, name, key):
+        with self._lock:
+            getattr(self, name)[key] += 1
+
+    def backoff(self, attempt, error):
+        retry_after = isinstance(error, HttpError) and error.resp.get("retry-after")
+        if retry_after and retry_after.isdigit():
+            return min(self.max_delay, int(retry_after))
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def run(self, key, file_id, call, tokens=1, idempotent=True):
+        """Run `call()` under the quota for `key`, retrying transient errors.
+
+        A batch request takes one token per request in it. Calls that aren't
+        `idempotent` are only retried when they were rate limited.
+        """
+        bucket = self.buckets.get(key)
+        self._count("requests", key)
+        attempt = 0
+
+        while True:
+            self._add("waiting", 1)
+            try:
+                throttled = bucket.acquire(tokens) if bucket else 0
+                if file_id:
+                    self._acquire_slot(file_id)
+            finally:
+                self._add("waiting", -1)
+
+            self._add("throttled_seconds", throttled)
+            self._add("in_flight", 1)
+            try:
+                return call()
+            except Exception as error:
+                if attempt >= self.max_retries or not is_retryable(error, idempotent):
+                    self._count("failures", key)
+                    raise
+
+                delay = self.backoff(attempt, error)
+                print(f"Retrying {key[0]} {key[1]} in {delay:.2f}s: {error}")
+            finally:
+                self._add("in_flight", -1)
+                if file_id:
+                    self._release_slot(file_id)
+
+            self._count("retries", key)
+            attempt += 1
+            time.sleep(delay)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self.waiting,
+                "in_flight": self.in_flight,
+                "active_spreadsheets": len(self._active),
+                "throttled_seconds": self.throttled_seconds,
+                "requests": {".".join(key): n for (key, n) in self.requests.items()},
+                "retries": {".".join(key): n for (key, n) in self.retries.items()},
+                "failures": {".".join(key): n for (key, n) in self.failures.items()},
+            }
+
+
+def request_key(request):
+    # methodId looks like `sheets.spreadsheets.values.get`
+    api = (request.methodId or "").split(".")[0]
+    kind = "read" if request.method == "GET" else "write"
+    return (api, kind)
+
+
+def request_file_id(request):
+    match = FILE_ID_PATTERN.search(request.uri.split("?")[0])
+    return match.group(1) if match else None
+
+
+# drive has one quota for reads and writes together
+drive_bucket = TokenBucket(int(os.getenv("DRIVE_REQUESTS_PER_MINUTE") or 12000))
+
+scheduler = Scheduler(
+    limits={
+        ("sheets", "read"): int(os.getenv("SHEETS_READS_PER_MINUTE") or 60),
+        ("sheets", "write"): int(os.getenv("SHEETS_WRITES_PER_MINUTE") or 60),
+        ("drive", "read"): drive_bucket,
+        ("drive", "write"): drive_bucket,
+    },
+    max_per_spreadsheet=int(os.getenv("MAX_REQUESTS_PER_SPREADSHEET") or 4),
+    max_retries=int(os.getenv("GOOGLE_API_MAX_RETRIES") or 5),
+)
+
+
+class ScheduledHttpRequest(HttpRequest):
+    """HttpRequest whose execute() goes through the shared scheduler."""
+
+    def execute(self, http=None, num_retries=0):
+        file_id = request_file_id(self)
+        call = lambda: super(ScheduledHttpRequest, self).execute(http=http)
+
+        if metrics.ENABLED:
+            call = metrics.instrument(self, call)
+
+        # only reads are sent again after a failure that may have been applied
+        return scheduler.run(
+            request_key(self), file_id, call, idempotent=self.method == "GET"
+        )
@@ -0,0 +1,252 @@
+import re
+import time
+import asyncio
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+
+from .executor import run_sync
+from .google_drive import list_spreadsheets
+from .google_sheets import SHEET_NAMES, batch_get_spreadsheet_data
+from .row_index import RowIndex, date_key, overlaps
+
+SEARCH_COLUMNS = ["name", "location_1", "location_2", "notes"]
+
+
+def words(text):
+    # case and accents don't matter, `Café` matches `cafe`
+    text = unicodedata.normalize("NFKD", str(text).casefold())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return re.findall(r"\w+", text)
+
+
+class SearchIndex:
+    """Rows of every itinerary in a set of folders, indexed for search.
+
+    Each word of the `name`, location and `notes` columns maps to the rows
+    it appears in, and each itinerary's rows are kept in a `RowIndex` for
+    date range lookups. Itineraries are re-read only when their Drive
+    `modifiedTime` changes, from the replica when it has them.
+    """
+
+    counters = ("syncs", "reads", "errors")
+
+    def __init__(
+        self,
+        credentials,
+        folder_ids,
+        interval=300,
+        concurrency=4,
+        folder_index=None,
+        replica=None,
+    ):
+        self.credentials = credentials
+        self.folder_ids = list(folder_ids)
+        self.interval = interval
+        self.concurrency = concurrency
+        self.folder_index = folder_index
+        self.replica = replica
+
+        self._itineraries = {}
+        self._postings = {}
+        self._lock = threading.Lock()
+
+        self.last_sync = None
+        self.syncs = 0
+        self.reads = 0
+        self.errors = 0
+
+    def _remove(self, file_id):
+        entry = self._itineraries.pop(file_id, None)
+        if entry is None:
+            return
+
+        for word in entry["words"]:
+            postings = self._postings[word]
+            del postings[file_id]
+            if not postings:
+                del self._postings[word]
+
+    def update(self, file, folder_id, data):
+        """Index the rows of an itinerary, replacing what was indexed before."""
+        # blank and unnamed rows aren't worth finding
+        rows = [
+            {**row, "category": category}
+            for category in SHEET_NAMES
+            for row in data.get(category, [])
+            if row.get("name")
+        ]
+
+        positions = {}
+        for position, row in enumerate(rows):
+            for column in SEARCH_COLUMNS:
+                for word in words(row.get(column) or ""):
+                    positions.setdefault(word, set()).add(position)
+
+        entry = {
+            "file": file,
+            "folder_id": folder_id,
+            "rows": rows,
+            "dates": RowIndex(rows),
+            "words": list(positions),
+        }
+
+        with self._lock:
+            self._remove(file["id"])
+            self._itineraries[file["id"]] = entry
+            for word, found in positions.items():
+                self._postings.setdefault(word, {})[file["id"]] = frozenset(found)
+
+    def remove(self, file_id):
+        with self._lock:
+            self._remove(file_id)
+
+    def _read(self, file, folder_id):
+        data = None
+        if self.replica:
+            data = self.replica.get(file["id"], file.get("modifiedTime"))
+        if data is None:
+            data = batch_get_spreadsheet_data(self.credentials, file["id"], SHEET_NAMES)
+
+        self.update(file, folder_id, data)
+        self.reads += 1
+
+    def sync(self):
+        if self.folder_index and self.folder_index.is_fresh():
+            listings = {
+                folder_id: self.folder_index.list(folder_id)
+                for folder_id in self.folder_ids
+            }
+        else:
+            listings = {
+                folder_id: list_spreadsheets(self.credentials, parent=folder_id)
+                for folder_id in self.folder_ids
+            }
+
+        if any(files is None for files in listings.values()):
+            raise RuntimeError("Could not list folders")
+
+        stale = []
+        current = set()
+
+        with self._lock:
+            for folder_id, files in listings.items():
+                for file in files:
+                    current.add(file["id"])
+                    entry = self._itineraries.get(file["id"])
+
+                    if entry is None or entry["file"].get("modifiedTime") != file.get(
+                        "modifiedTime"
+                    ):
+                        stale.append((file, folder_id))
+                    else:
+                        # moving a file doesn't change its contents
+                        entry["file"] = file
+                        entry["folder_id"] = folder_id
+
+            for file_id in self._itineraries.keys() - current:
+                self._remove(file_id)
+
+        def read(item):
+            try:
+                self._read(*item)
+            except Exception as error:
+                self.errors += 1
+                print(f"An error occurred indexing {item[0]['id']}: {error}")
+
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            list(executor.map(read, stale))
+
+        self.last_sync = time.monotonic()
+        self.syncs += 1
+
+    def is_ready(self):
+        return self.last_sync is not None
+
+    def search(
+        self,
+        text=None,
+        date_from=None,
+        date_to=None,
+        categories=None,
+        folder_ids=None,
+    ):
+        """(file, folder id, row) of the rows matching every word and the dates.
+
+        Rows are ordered by `date_start`, undated rows last, then by itinerary.
+        """
+        query = words(text) if text else []
+        date_from = date_from and date_from.isoformat()
+        date_to = date_to and date_to.isoformat()
+        hits = []
+
+        with self._lock:
+            if query:
+                # itineraries with every word, then their rows with every word
+                postings = sorted(
+                    (self._postings.get(word, {}) for word in set(query)), key=len
+                )
+                candidates = {
+                    file_id: set.intersection(
+                        *(set(found[file_id]) for found in postings)
+                    )
+                    for file_id in postings[0]
+                    if all(file_id in found for found in postings[1:])
+                }
+            else:
+                candidates = dict.fromkeys(self._itineraries)
+
+            for file_id, found in candidates.items():
+                entry = self._itineraries[file_id]
+                if folder_ids and entry["folder_id"] not in folder_ids:
+                    continue
+
+                if found is None:
+                    rows = entry["dates"].between(date_from, date_to)
+                else:
+                    rows = [
+                        entry["rows"][position]
+                        for position in sorted(found)
+                        if overlaps(entry["rows"][position], date_from, date_to)
+                    ]
+
+                hits += [
+                    (entry["file"], entry["folder_id"], row)
+                    for row in rows
+                    if not categories or row["category"] in categories
+                ]
+
+        hits.sort(
+            key=lambda hit: (
+                date_key(hit[2], "date_start") is None,
+                date_key(hit[2], "date_start") or "",
+                hit[0].get("name", ""),
+                SHEET_NAMES.index(hit[2]["category"]),
+                hit[2]["index"],
+            )
+        )
+        return hits
+
+    async def run(self):
+        while True:
+            try:
+                await run_sync(self.sync)
+            except Exception as error:
+                self.errors += 1
+                print(f"An error occurred syncing the search index: {error}")
+
+            await asyncio.sleep(self.interval)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "itineraries": len(self._itineraries),
+                "rows": sum(len(entry["rows"]) for entry in self._itineraries.values()),
+                "words": len(self._postings),
+                "sync_lag_seconds": (
+                    time.monotonic() - self.last_sync if self.last_sync else None
+                ),
+                "syncs": self.syncs,
+                "reads": self.reads,
+                "errors": self.errors,
+            }
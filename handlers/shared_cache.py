@@ -0,0 +1,265 @@
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from urllib.parse import urlsplit
+
+try:
+    import redis
+except ImportError:  # optional, `pip install redis`
+    redis = None
+
+PURGE_EVERY = 1000
+
+
+class SQLiteBackend:
+    """Expiring keys in a SQLite file, shared by the processes on one host."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.writes = 0
+
+        with self._connection() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    expires REAL NOT NULL
+                )
+                """)
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads, keep one per thread
+        connection = getattr(self._local, "connection", None)
+
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+
+        return connection
+
+    def get(self, key):
+        row = (
+            self._connection()
+            .execute(
+                "SELECT value FROM cache WHERE key = ? AND expires > ?",
+                (key, time.time()),
+            )
+            .fetchone()
+        )
+        return row and row[0]
+
+    def set(self, key, value, ttl):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl),
+            )
+
+        # expired keys are skipped by reads, drop them now and then
+        self.writes += 1
+        if self.writes >= PURGE_EVERY:
+            self.purge()
+
+    def add(self, key, value, ttl):
+        """Set `key` unless it holds an unexpired value, return whether it was set."""
+        now = time.time()
+        with self._connection() as connection:
+            connection.execute(
+                "DELETE FROM cache WHERE key = ? AND expires <= ?", (key, now)
+            )
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO cache VALUES (?, ?, ?)", (key, value, now + ttl)
+            )
+            return cursor.rowcount == 1
+
+    def delete(self, key, value=None):
+        """Delete `key`, only while it holds `value` if one is given."""
+        with self._connection() as connection:
+            if value is None:
+                connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+            else:
+                connection.execute(
+                    "DELETE FROM cache WHERE key = ? AND value = ?", (key, value)
+                )
+
+    def purge(self):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+        self.writes = 0
+
+
+class RedisBackend:
+    """Expiring keys in Redis, or a server speaking its protocol."""
+
+    # delete a lock only if it's still ours
+    RELEASE = """
+        if redis.call("get", KEYS[1]) == ARGV[1] then
+            return redis.call("del", KEYS[1])
+        end
+        return 0
+    """
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("The redis package is needed for a redis:// cache")
+
+        self.client = redis.Redis.from_url(url)
+        self._release = self.client.register_script(self.RELEASE)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, px=int(ttl * 1000))
+
+    def add(self, key, value, ttl):
+        return bool(self.client.set(key, value, px=int(ttl * 1000), nx=True))
+
+    def delete(self, key, value=None):
+        if value is None:
+            self.client.delete(key)
+        else:
+            self._release(keys=[key], args=[value])
+
+
+def open_backend(url):
+    """Backend for `sqlite:///path/to/cache.db` or `redis://host:port/db`."""
+    scheme = urlsplit(url).scheme
+
+    if scheme == "sqlite":
+        return SQLiteBackend(url.removeprefix("sqlite:///"))
+    if scheme in ("redis", "rediss", "unix"):
+        return RedisBackend(url)
+
+    raise ValueError(f"Unsupported shared cache url: {url}")
+
+
+class SharedCache:
+    """JSON values cached in a backend shared by all worker processes.
+
+    `get_or_fetch` lets one caller fetch a missing key while the others,
+    in any process, wait for its result instead of fetching it too.
+    """
+
+    counters = ("hits", "misses", "fetches", "waits", "errors")
+
+    def __init__(self, backend, ttl=300, lock_timeout=30, poll_interval=0.05):
+        self.backend = backend
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.waits = 0
+        self.errors = 0
+
+    def _read(self, key):
+        try:
+            value = self.backend.get(key)
+        except Exception as error:
+            # a cache that's down shouldn't fail the request
+            self.errors += 1
+            print(f"An error occurred reading the shared cache: {error}")
+            return None
+
+        return None if value is None else json.loads(value)
+
+    def get(self, key):
+        value = self._read(key)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return value
+
+    def set(self, key, value, ttl=None):
+        try:
+            self.backend.set(key, json.dumps(value), ttl or self.ttl)
+        except Exception as error:
+            self.errors += 1
+            print(f"An error occurred writing the shared cache: {error}")
+
+    def delete(self, key):
+        try:
+            self.backend.delete(key)
+        except Exception as error:
+            self.errors += 1
+            print(f"An error occurred writing the shared cache: {error}")
+
+    def _lock(self, key, token):
+        try:
+            return self.backend.add(f"lock:{key}", token, self.lock_timeout)
+        except Exception as error:
+            self.errors += 1
+            print(f"An error occurred locking the shared cache: {error}")
+            return True
+
+    def _unlock(self, key, token):
+        try:
+            self.backend.delete(f"lock:{key}", token)
+        except Exception as error:
+            self.errors += 1
+            print(f"An error occurred unlocking the shared cache: {error}")
+
+    def get_or_fetch(self, key, fetch, ttl=None, valid=None):
+        """Cached value of `key`, or `fetch()` run by one caller at a time.
+
+        A None result is returned but not cached. A cached value that
+        `valid(value)` rejects is fetched again, as if it were missing.
+        """
+
+        def read():
+            value = self._read(key)
+            if value is not None and valid and not valid(value):
+                return None
+            return value
+
+        value = read()
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.lock_timeout
+
+        while not self._lock(key, token):
+            time.sleep(self.poll_interval)
+
+            value = read()
+            if value is not None:
+                self.waits += 1
+                return value
+
+            if time.monotonic() > deadline:
+                # the fetching worker is stuck or gone, don't wait on it
+                break
+
+        try:
+            # another worker may have filled it before we got the lock
+            value = read()
+            if value is None:
+                self.fetches += 1
+                value = fetch()
+                if value is not None:
+                    self.set(key, value, ttl)
+            return value
+        finally:
+            self._unlock(key, token)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "fetches": self.fetches,
+            "waits": self.waits,
+            "errors": self.errors,
+        }
@@ -0,0 +1,99 @@
+import time
+import asyncio
+
+from .executor import run_sync
+
+
+class SingleFlight:
+    """Concurrent identical reads share one upstream call.
+
+    Calls are keyed by a tuple whose second item is the id of the file or
+    folder read. Results of calls made with `keep=True` are also served for
+    `max_age` seconds, then for `stale_while_revalidate` more seconds while
+    one refresh runs in the background, so readers don't wait on it.
+    """
+
+    counters = ("calls", "shared", "fresh", "stale", "errors")
+
+    def __init__(self, max_age=0, stale_while_revalidate=0):
+        self.max_age = max_age
+        self.stale_while_revalidate = stale_while_revalidate
+
+        self._flights = {}
+        self._results = {}
+
+        self.calls = 0
+        self.shared = 0
+        self.fresh = 0
+        self.stale = 0
+        self.errors = 0
+
+    @property
+    def keeps(self):
+        return self.max_age + self.stale_while_revalidate > 0
+
+    def _start(self, key, func, keep):
+        task = asyncio.ensure_future(run_sync(func))
+        self._flights[key] = task
+        self.calls += 1
+        started = time.monotonic()
+
+        def done(task):
+            failed = task.cancelled() or task.exception() is not None
+            if failed:
+                self.errors += 1
+
+            # a forgotten call may have read data older than the change
+            if self._flights.get(key) is not task:
+                return
+            del self._flights[key]
+
+            if keep and self.keeps and not failed:
+                self._results[key] = (started, task.result())
+
+        task.add_done_callback(done)
+        return task
+
+    async def run(self, key, func, keep=False):
+        """Result of `func()`, shared with the callers of the same `key`."""
+        if keep and key in self._results:
+            started, result = self._results[key]
+            age = time.monotonic() - started
+
+            if age < self.max_age:
+                self.fresh += 1
+                return result
+
+            if age < self.max_age + self.stale_while_revalidate:
+                if key not in self._flights:
+                    self._start(key, func, keep)
+                self.stale += 1
+                return result
+
+            del self._results[key]
+
+        task = self._flights.get(key)
+        if task is None:
+            task = self._start(key, func, keep)
+        else:
+            self.shared += 1
+
+        # a client going away mustn't cancel the call others are waiting on
+        return await asyncio.shield(task)
+
+    def forget(self, id):
+        """Drop results and calls in flight for a file or folder that changed."""
+        for entries in (self._results, self._flights):
+            for key in [key for key in entries if key[1] == id]:
+                del entries[key]
+
+    def stats(self):
+        return {
+            "in_flight": len(self._flights),
+            "kept": len(self._results),
+            "calls": self.calls,
+            "shared": self.shared,
+            "fresh": self.fresh,
+            "stale": self.stale,
+            "errors": self.errors,
+        }
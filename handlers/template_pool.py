@@ -0,0 +1,252 @@
+import uuid
+import asyncio
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from googleapiclient.errors import HttpError
+
+from .executor import run_sync
+from .google_drive import (
+    get_file,
+    copy_file,
+    update_file,
+    delete_file,
+    create_folder,
+    list_folders,
+    list_spreadsheets,
+)
+
+STAGING_FOLDER = "Staging"
+STAGED_NAME = "Staged itinerary"
+
+
+def age(file):
+    created = datetime.fromisoformat(file["createdTime"].replace("Z", "+00:00"))
+    return (datetime.now(timezone.utc) - created).total_seconds()
+
+
+class TemplatePool:
+    """Copies of the template itinerary made ahead of time.
+
+    Copies are staged in a `Staging` folder next to the template and named
+    after the template version and the pool that made them. Creating an
+    itinerary then only renames, moves and shares a staged copy. A pool only
+    hands out its own copies, so several workers can share the folder. Copies
+    are replaced when the template changes or after `max_age` seconds. Copies
+    left behind by other pools are deleted after twice that.
+    """
+
+    counters = ("assigned", "misses", "copies", "deleted", "errors")
+
+    def __init__(
+        self,
+        credentials,
+        template_id,
+        templates_folder_id,
+        size=3,
+        concurrency=2,
+        max_age=86400,
+        interval=300,
+    ):
+        self.credentials = credentials
+        self.template_id = template_id
+        self.templates_folder_id = templates_folder_id
+        self.size = size
+        self.concurrency = concurrency
+        self.max_age = max_age
+        self.interval = interval
+
+        self.staging_id = None
+        self.template_version = None
+        self.instance = uuid.uuid4().hex[:8]
+
+        self._copies = deque()
+        self._stale = []
+        self._lock = threading.Lock()
+        self._wakeup = None
+
+        self.assigned = 0
+        self.misses = 0
+        self.copies = 0
+        self.deleted = 0
+        self.errors = 0
+
+    def _name(self, version):
+        return f"{STAGED_NAME} {version} {self.instance}"
+
+    def _check_template(self):
+        """Fetch the template version, retire copies made from an older one."""
+        version = get_file(self.credentials, self.template_id, fields="version")[
+            "version"
+        ]
+
+        with self._lock:
+            if version != self.template_version:
+                self._stale += self._copies
+                self._copies.clear()
+                self.template_version = version
+
+        return version
+
+    def _find_staging(self):
+        folders = list_folders(self.credentials, parent=self.templates_folder_id)
+        if folders is None:
+            raise RuntimeError("Could not list template folders")
+
+        for folder in folders:
+            if folder["name"] == STAGING_FOLDER:
+                return folder["id"]
+
+        folder = create_folder(
+            self.credentials, STAGING_FOLDER, parent=self.templates_folder_id
+        )
+        if folder is None:
+            raise RuntimeError("Could not create staging folder")
+        return folder["id"]
+
+    def _copy(self, version):
+        file = copy_file(
+            self.credentials,
+            file_id=self.template_id,
+            name=self._name(version),
+            parent_id=self.staging_id,
+        )
+        if file is None:
+            self.errors += 1
+            return
+
+        with self._lock:
+            if version == self.template_version:
+                self._copies.append(file["id"])
+                self.copies += 1
+                return
+            self._stale.append(file["id"])
+
+    def _delete_stale(self):
+        with self._lock:
+            stale, self._stale = self._stale, []
+
+        for file_id in stale:
+            delete_file(self.credentials, file_id)
+            self.deleted += 1
+
+    def cleanup(self):
+        """Retire our expired copies, delete copies abandoned by other pools."""
+        files = list_spreadsheets(self.credentials, parent=self.staging_id)
+        if files is None:
+            raise RuntimeError("Could not list staging folder")
+
+        with self._lock:
+            for file in files:
+                if file["id"] in self._copies:
+                    if age(file) > self.max_age:
+                        self._copies.remove(file["id"])
+                        self._stale.append(file["id"])
+                elif not file["name"].endswith(self.instance):
+                    # leave time for their own pool to retire them
+                    if age(file) > 2 * self.max_age:
+                        self._stale.append(file["id"])
+
+        self._delete_stale()
+
+    def fill(self):
+        with self._lock:
+            version = self.template_version
+            missing = self.size - len(self._copies)
+
+        if missing > 0:
+            with ThreadPoolExecutor(self.concurrency) as executor:
+                list(executor.map(self._copy, [version] * missing))
+
+        self._delete_stale()
+
+    def refresh(self):
+        if self.staging_id is None:
+            self.staging_id = self._find_staging()
+
+        self._check_template()
+        self.cleanup()
+        self.fill()
+
+    def assign(self, name, parent_id):
+        """Rename and move a staged copy into `parent_id`, or None if none is ready."""
+        if self.template_version is None or not self._copies:
+            self.misses += 1
+            return None
+
+        # a staged copy is only good while the template is unchanged
+        try:
+            self._check_template()
+        except HttpError as error:
+            print(f"An error occurred: {error}")
+            self.misses += 1
+            return None
+
+        with self._lock:
+            file_id = self._copies.popleft() if self._copies else None
+
+        if file_id is None:
+            self.misses += 1
+            return None
+
+        file = update_file(
+            self.credentials,
+            file_id,
+            name=name,
+            add_parent_id=parent_id,
+            remove_parent_id=self.staging_id,
+        )
+
+        if file is None:
+            self.misses += 1
+            return None
+
+        self.assigned += 1
+        return file
+
+    def close(self):
+        """Delete the copies that are still staged."""
+        with self._lock:
+            self._stale += self._copies
+            self._copies.clear()
+
+        self._delete_stale()
+
+    def wake(self):
+        # refill now rather than at the next interval
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        full = True
+
+        while True:
+            try:
+                ready = self.staging_id and self.template_version
+                await run_sync(self.fill if ready and not full else self.refresh)
+            except Exception as error:
+                self.errors += 1
+                print(f"An error occurred filling the template pool: {error}")
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+                full = False
+            except asyncio.TimeoutError:
+                full = True
+
+            self._wakeup.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "staged": len(self._copies),
+                "size": self.size,
+                "assigned": self.assigned,
+                "misses": self.misses,
+                "copies": self.copies,
+                "deleted": self.deleted,
+                "errors": self.errors,
+            }
@@ -0,0 +1,250 @@
+import asyncio
+
+from .executor import run_sync
+from .google_sheets import batch_update_sheets
+
+
+def present(data):
+    return {key: value for (key, value) in data.items() if value is not None}
+
+
+class WriteBehindQueue:
+    """Buffer row writes per spreadsheet and flush them as one batch.
+
+    Writes to the same row are merged (last write wins) and appends are kept in
+    order; updates to rows that are still buffered appends are merged into
+    them. A spreadsheet's buffer is flushed `delay` seconds after its first
+    buffered write, or as soon as it holds `max_size` writes. Failed flushes
+    are put back and retried up to `max_retries` times, unless they held
+    appends that may have been made, after which their writes are counted
+    as lost. Runs on the event loop; flushes for the same spreadsheet never
+    overlap.
+    """
+
+    counters = ("flushes", "failed_flushes", "lost_writes")
+
+    def __init__(
+        self, credentials, delay=0.3, max_size=50, max_retries=3, on_flush=None
+    ):
+        self.credentials = credentials
+        self.delay = delay
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self.on_flush = on_flush
+
+        self._pending = {}
+        self._inflight = {}
+        self._timers = {}
+        self._locks = {}
+        self._tasks = set()
+        self._attempts = {}
+
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.lost_writes = 0
+
+    def _buffer(self, spreadsheet_id):
+        return self._pending.setdefault(spreadsheet_id, {"updates": {}, "appends": []})
+
+    def _size(self, spreadsheet_id):
+        buffer = self._pending.get(spreadsheet_id)
+        return len(buffer["updates"]) + len(buffer["appends"]) if buffer else 0
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _lock(self, spreadsheet_id):
+        return self._locks.setdefault(spreadsheet_id, asyncio.Lock())
+
+    def _schedule(self, spreadsheet_id, delay=None):
+        if delay is not None:
+            # a retry's backoff replaces timers started while the flush was failing
+            timer = self._timers.pop(spreadsheet_id, None)
+            if timer:
+                timer.cancel()
+
+        if delay is None and self._size(spreadsheet_id) >= self.max_size:
+            self._spawn(self.flush(spreadsheet_id))
+        elif spreadsheet_id not in self._timers:
+            self._timers[spreadsheet_id] = self._spawn(
+                self._flush_later(spreadsheet_id, delay or self.delay)
+            )
+
+    async def _flush_later(self, spreadsheet_id, delay):
+        await asyncio.sleep(delay)
+        await self.flush(spreadsheet_id)
+
+    def has_appends(self, spreadsheet_id, sheet_name):
+        buffer = self._pending.get(spreadsheet_id)
+        return bool(buffer) and any(
+            name == sheet_name for (name, _) in buffer["appends"]
+        )
+
+    async def update(self, spreadsheet_id, sheet_name, index, data, last_index):
+        """Buffer a row update.
+
+        When the sheet has buffered appends, `await last_index()` must return
+        the index of its last row in the spreadsheet, so updates to appended
+        rows can be told apart. Flushes wait until the update is buffered.
+        """
+        async with self._lock(spreadsheet_id):
+            if self.has_appends(spreadsheet_id, sheet_name):
+                appends = self._pending[spreadsheet_id]["appends"]
+                positions = [
+                    position
+                    for (position, (name, _)) in enumerate(appends)
+                    if name == sheet_name
+                ]
+                number = index - await last_index() - 1
+
+                if 0 <= number < len(positions):
+                    # the row isn't in the sheet yet, edit what will be appended
+                    position = positions[number]
+                    appends[position] = (
+                        sheet_name,
+                        {**appends[position][1], **present(data)},
+                    )
+                    return
+
+            updates = self._buffer(spreadsheet_id)["updates"]
+            updates.pop((sheet_name, index), None)
+            updates[(sheet_name, index)] = data
+            self._schedule(spreadsheet_id)
+
+    def append(self, spreadsheet_id, sheet_name, data):
+        self._buffer(spreadsheet_id)["appends"].append((sheet_name, data))
+        self._schedule(spreadsheet_id)
+
+    def _restore(self, spreadsheet_id, buffer):
+        # put failed writes back in front of the ones buffered since
+        pending = self._pending.pop(spreadsheet_id, None)
+        if pending:
+            buffer["updates"].update(pending["updates"])
+            buffer["appends"] += pending["appends"]
+        self._pending[spreadsheet_id] = buffer
+
+    async def flush(self, spreadsheet_id):
+        retry = None
+
+        async with self._lock(spreadsheet_id):
+            timer = self._timers.pop(spreadsheet_id, None)
+            if timer and timer is not asyncio.current_task():
+                timer.cancel()
+
+            buffer = self._pending.pop(spreadsheet_id, None)
+            if not buffer:
+                return
+
+            operations = [
+                {"op": "update", "sheet_name": sheet_name, "index": index, "data": data}
+                for ((sheet_name, index), data) in buffer["updates"].items()
+            ] + [
+                {"op": "create", "sheet_name": sheet_name, "data": data}
+                for (sheet_name, data) in buffer["appends"]
+            ]
+
+            self._inflight[spreadsheet_id] = buffer
+            try:
+                results = await run_sync(
+                    batch_update_sheets,
+                    self.credentials,
+                    spreadsheet_id=spreadsheet_id,
+                    operations=operations,
+                )
+            except Exception as error:
+                self.failed_flushes += 1
+                attempts = self._attempts.get(spreadsheet_id, 0) + 1
+                # a failed call may still have appended rows, send appends
+                # again only when the sheets turned the batch away
+                repeatable = (
+                    not buffer["appends"] or getattr(error, "status_code", None) == 429
+                )
+
+                if attempts > self.max_retries or not repeatable:
+                    self._attempts.pop(spreadsheet_id, None)
+                    self.lost_writes += len(operations)
+                    print(
+                        f"Gave up flushing {len(operations)} writes "
+                        f"to {spreadsheet_id}: {error}"
+                    )
+                else:
+                    # the writes were acknowledged, keep them for another attempt
+                    self._attempts[spreadsheet_id] = attempts
+                    self._restore(spreadsheet_id, buffer)
+                    retry = self.delay * 2**attempts
+                    print(f"An error occurred flushing {spreadsheet_id}: {error}")
+            else:
+                self._attempts.pop(spreadsheet_id, None)
+                self.flushes += 1
+
+                rejected = [result for result in results if result["status"] != "ok"]
+                self.lost_writes += len(rejected)
+                for result in rejected:
+                    print(
+                        f"Could not write to {spreadsheet_id} "
+                        f"{result['sheet_name']}: {result['detail']}"
+                    )
+                print(f"Flushed {len(operations)} writes to {spreadsheet_id}.")
+            finally:
+                del self._inflight[spreadsheet_id]
+                if self.on_flush:
+                    self.on_flush(spreadsheet_id)
+
+        if retry:
+            self._schedule(spreadsheet_id, retry)
+
+    async def drain(self):
+        # flush everything now, then wait out timers, flushes and their retries
+        await asyncio.gather(*[self.flush(id) for id in list(self._pending)])
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def has_pending(self, spreadsheet_id):
+        return spreadsheet_id in self._pending or spreadsheet_id in self._inflight
+
+    def overlay(self, spreadsheet_id, data):
+        """Apply in-flight and pending writes to rows read from the sheets."""
+        buffers = [
+            buffer
+            for buffer in (
+                self._inflight.get(spreadsheet_id),
+                self._pending.get(spreadsheet_id),
+            )
+            if buffer
+        ]
+        if not buffers:
+            return data
+
+        data = {sheet_name: list(rows) for (sheet_name, rows) in data.items()}
+
+        for buffer in buffers:
+            # appends are numbered first, updates may be to appended rows
+            for sheet_name, values in buffer["appends"]:
+                rows = data.setdefault(sheet_name, [])
+                rows.append(
+                    {
+                        **present(values),
+                        "index": rows[-1]["index"] + 1 if rows else 1,
+                    }
+                )
+
+            for (sheet_name, index), values in buffer["updates"].items():
+                rows = data.get(sheet_name, [])
+                for position, row in enumerate(rows):
+                    if row["index"] == index:
+                        # unset fields are left unchanged, as with values.update
+                        rows[position] = {**row, **present(values), "index": index}
+
+        return data
+
+    def stats(self):
+        return {
+            "pending_spreadsheets": len(self._pending),
+            "pending_writes": sum(self._size(id) for id in self._pending),
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "lost_writes": self.lost_writes,
+        }
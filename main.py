@@ -1,10 +1,19 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 
 from .api import api
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    # mounted apps don't receive lifespan events, run the api's from here
+    async with api.router.lifespan_context(api):
+        yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.mount("/api", api)
 app.mount("/", StaticFiles(directory="static", html=True), name="static")
@@ -1,27 +1,124 @@
-from fastapi import APIRouter, HTTPException, Request
-from ..handlers.google_drive import list_spreadsheets, get_parent_ids, delete_file
+from typing import Annotated, Literal
+from datetime import datetime, timedelta, timezone
+from fastapi import APIRouter, HTTPException, Request, Response, Query
+from pydantic import BaseModel, Field
+from .manage_itineraries import (
+    FileIds,
+    BulkResult,
+    list_folder,
+    check_parents,
+    move_files,
+    failed,
+    forget_listings,
+    forget_itinerary,
+)
+from ..handlers.google_drive import (
+    get_parent_ids,
+    delete_file,
+    list_spreadsheets,
+    batch_delete_files,
+)
+from ..handlers.executor import run_sync
+
+
+class Purge(BaseModel):
+    older_than_days: float = Field(ge=0)
+
+
+async def forget_deleted(request, id):
+    """Drop a deleted itinerary from the caches, indexes and replica."""
+    forget_itinerary(request, id)
+    if request.app.folder_index:
+        request.app.folder_index.remove(id)
+    if request.app.search_index:
+        request.app.search_index.remove(id)
+    if request.app.replica:
+        await run_sync(request.app.replica.remove, id)
+
 
 router = APIRouter()
 
 
 @router.get("")
-def get_archived_itineraries(request: Request):
-    response = list_spreadsheets(
-        request.app.credentials, parent=request.app.folders["Archives"]
-    )
-    return response
+async def get_archived_itineraries(
+    request: Request,
+    response: Response,
+    page_size: Annotated[int | None, Query(ge=1, le=1000)] = None,
+    cursor: str | None = None,
+    format: Literal["json", "ndjson"] = "json",
+):
+    return await list_folder(request, response, "Archives", page_size, cursor, format)
+
+
+@router.post("/restore", response_model_exclude_none=True)
+async def restore_archived_itineraries(
+    request: Request, body: FileIds
+) -> list[BulkResult]:
+    return await move_files(request, body.ids, "Archives", "Itineraries")
+
+
+@router.post("/purge", response_model_exclude_none=True)
+async def purge_archived_itineraries(request: Request, body: Purge) -> list[BulkResult]:
+    """Permanently delete archived itineraries not modified in `older_than_days`."""
+    index = request.app.folder_index
+    parent = request.app.folders["Archives"]
+
+    if index and index.is_fresh():
+        files = index.list(parent)
+    else:
+        files = await run_sync(
+            list_spreadsheets, request.app.credentials, parent=parent
+        )
+        if files is None:
+            raise HTTPException(status_code=502, detail="Could not list archives")
+
+    cutoff = datetime.now(timezone.utc) - timedelta(days=body.older_than_days)
+    # files the index has no modifiedTime for yet are left for a later purge
+    ids = [
+        file["id"]
+        for file in files
+        if file.get("modifiedTime")
+        and datetime.fromisoformat(file["modifiedTime"].replace("Z", "+00:00")) < cutoff
+    ]
+    if not ids:
+        return []
+
+    results = dict.fromkeys(ids)
+    # files restored since the listing must not be deleted
+    ids, rejected = await check_parents(request, ids, "Archives")
+    results.update(rejected)
+
+    deleted = await run_sync(batch_delete_files, request.app.credentials, ids)
+    forget_listings(request, "Archives")
+
+    for id, (_, error) in zip(ids, deleted):
+        if error:
+            results[id] = failed(id, error)
+            continue
+
+        results[id] = {"id": id, "status": "ok"}
+        await forget_deleted(request, id)
+
+    return list(results.values())
 
 
 @router.delete("/{id}")
-def permanently_delete_archived_itinerary(request: Request, id: str):
-    response = get_parent_ids(request.app.credentials, file_id=id)
-    parent = response.get("parents", [])[0]
+async def permanently_delete_archived_itinerary(request: Request, id: str):
+    index = request.app.folder_index
+    parent = index.parent(id) if index and index.is_fresh() else None
+
+    if parent != request.app.folders["Archives"]:
+        # the index may lag behind, confirm with drive before refusing
+        response = await run_sync(get_parent_ids, request.app.credentials, file_id=id)
+        parent = response.get("parents", [])[0]
 
     if parent != request.app.folders["Archives"]:
         raise HTTPException(
             status_code=403, detail="Attempting to delete an active itinerary"
         )
 
-    response = delete_file(request.app.credentials, id)
+    response = await run_sync(delete_file, request.app.credentials, id)
+    forget_listings(request, "Archives")
+    await forget_deleted(request, id)
 
     return response
@@ -0,0 +1,72 @@
+import hashlib
+from datetime import datetime
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Response
+
+
+def file_etag(file, variant=None):
+    # drive bumps `version` on every change to the file, including its content
+    tag = f'{file["id"]}-{file.get("version") or file.get("modifiedTime")}'
+    # other representations of the file need their own tag
+    return f'W/"{tag}-{variant}"' if variant else f'W/"{tag}"'
+
+
+def listing_etag(files):
+    digest = hashlib.sha1()
+    for file in files:
+        digest.update(
+            f"{file['id']}:{file.get('version')}:{file.get('name')};".encode()
+        )
+    return f'W/"{digest.hexdigest()}"'
+
+
+def last_modified(files):
+    times = [file["modifiedTime"] for file in files if file.get("modifiedTime")]
+    if not times:
+        return None
+
+    modified = datetime.fromisoformat(max(times).replace("Z", "+00:00"))
+    return format_datetime(modified.replace(microsecond=0), usegmt=True)
+
+
+def is_not_modified(request, etag, modified=None):
+    """Evaluate If-None-Match, or If-Modified-Since when no ETags are sent."""
+    if_none_match = request.headers.get("if-none-match")
+
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        # weak comparison
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return etag.removeprefix("W/") in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+
+    if if_modified_since and modified:
+        try:
+            return parsedate_to_datetime(modified) <= parsedate_to_datetime(
+                if_modified_since
+            )
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+
+def is_conditional(request):
+    return "if-none-match" in request.headers or "if-modified-since" in request.headers
+
+
+def validator_headers(etag, modified=None):
+    headers = {"ETag": etag}
+    if modified:
+        headers["Last-Modified"] = modified
+    return headers
+
+
+def not_modified(etag, modified=None, headers=None):
+    return Response(
+        status_code=304,
+        headers={**(headers or {}), **validator_headers(etag, modified)},
+    )
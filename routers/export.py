@@ -0,0 +1,198 @@
+import io
+import csv
+import json
+import zipfile
+from datetime import date, datetime, time, timedelta, timezone
+from urllib.parse import quote
+
+from .serialization import row_dict
+from ..handlers.executor import run_sync
+from ..handlers.google_sheets import COLUMNS, iter_itinerary_chunks
+
+MEDIA_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "ics": "text/calendar; charset=utf-8",
+    "jsonl": "application/jsonl",
+}
+
+CSV_FIELDS = ["category", "index", *COLUMNS]
+
+
+def csv_rows(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def ics_text(value):
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\n", "\\n")
+    )
+
+
+def ics_line(line):
+    # lines are folded at 75 octets, continuations start with a space
+    folded, current = [], ""
+    for char in line:
+        if len(current.encode()) + len(char.encode()) > 75:
+            folded.append(current)
+            current = " "
+        current += char
+    folded.append(current)
+    return "\r\n".join(folded) + "\r\n"
+
+
+def ics_moment(value):
+    value = str(value)
+    if len(value) <= 10:
+        return date.fromisoformat(value)
+
+    moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return moment.astimezone(timezone.utc) if moment.tzinfo else moment
+
+
+def ics_property(name, moment):
+    if isinstance(moment, datetime):
+        suffix = "Z" if moment.tzinfo else ""
+        return f"{name}:{moment.strftime('%Y%m%dT%H%M%S')}{suffix}"
+    return f"{name};VALUE=DATE:{moment.strftime('%Y%m%d')}"
+
+
+def ics_event(file, category, row, stamp):
+    try:
+        start = ics_moment(row["date_start"])
+        end = ics_moment(row["date_end"]) if row.get("date_end") else start
+    except (KeyError, ValueError):
+        # rows without a usable start date have no place on a calendar
+        return ""
+
+    # the end is exclusive, whole days end at the start of the next one
+    if not isinstance(start, datetime):
+        end = (end.date() if isinstance(end, datetime) else end) + timedelta(days=1)
+    elif not isinstance(end, datetime):
+        end = datetime.combine(end + timedelta(days=1), time(), start.tzinfo)
+
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{file['id']}-{category}-{row['index']}",
+        f"DTSTAMP:{stamp}",
+        ics_property("DTSTART", start),
+        ics_property("DTEND", end),
+        f"SUMMARY:{ics_text(row.get('name', ''))}",
+        f"CATEGORIES:{ics_text(category)}",
+    ]
+    if row.get("location_1"):
+        lines.append(f"LOCATION:{ics_text(row['location_1'])}")
+    details = [row[field] for field in ("location_2", "notes") if row.get(field)]
+    if details:
+        lines.append(f"DESCRIPTION:{ics_text(chr(10).join(details))}")
+    lines.append("END:VEVENT")
+
+    return "".join(ics_line(line) for line in lines)
+
+
+def export_pieces(format, file, chunks):
+    """Encoded export of an itinerary, one piece per window of rows read."""
+    if format == "csv":
+        yield csv_rows([CSV_FIELDS])
+        for category, rows in chunks:
+            yield csv_rows(
+                [category, row["index"], *[row.get(column) for column in COLUMNS]]
+                for row in rows
+            )
+
+    elif format == "ics":
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        header = [
+            "BEGIN:VCALENDAR",
+            "VERSION:2.0",
+            "PRODID:-//itineraries//export//EN",
+            f"X-WR-CALNAME:{ics_text(file['name'])}",
+        ]
+        yield "".join(ics_line(line) for line in header).encode()
+        for category, rows in chunks:
+            yield "".join(
+                ics_event(file, category, row, stamp) for row in rows
+            ).encode()
+        yield ics_line("END:VCALENDAR").encode()
+
+    else:
+        for category, rows in chunks:
+            yield "".join(
+                json.dumps({"category": category, **row_dict(row)}) + "\n"
+                for row in rows
+            ).encode()
+
+
+def itinerary_pieces(credentials, format, file):
+    return export_pieces(format, file, iter_itinerary_chunks(credentials, file["id"]))
+
+
+class Pipe(io.RawIOBase):
+    """Unseekable file that keeps what's written until it's drained."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def zip_pieces(credentials, format, files):
+    """A ZIP of one export per itinerary, yielded as it's compressed."""
+    pipe = Pipe()
+    names = set()
+
+    # zipfile writes data descriptors to unseekable files, no sizes needed up front
+    with zipfile.ZipFile(pipe, "w", zipfile.ZIP_DEFLATED) as archive:
+        for file in files:
+            name = filename(file["name"], format)
+            if name in names:
+                name = filename(f"{file['name']} {file['id']}", format)
+            names.add(name)
+
+            modified = datetime.fromisoformat(
+                file["modifiedTime"].replace("Z", "+00:00")
+            )
+            info = zipfile.ZipInfo(name, date_time=modified.timetuple()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+
+            with archive.open(info, "w") as entry:
+                for piece in itinerary_pieces(credentials, format, file):
+                    entry.write(piece)
+                    yield pipe.drain()
+            yield pipe.drain()
+
+    yield pipe.drain()
+
+
+def filename(name, extension):
+    safe = "".join(char if char not in '/\\:*?"<>|' else "_" for char in name)
+    return f"{safe.strip() or 'itinerary'}.{extension}"
+
+
+def attachment(name):
+    # ascii fallback first, then the utf-8 name for clients that support it
+    fallback = name.encode("ascii", "replace").decode().replace("?", "_")
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(name)}"
+
+
+async def iterate(pieces):
+    # pieces read from the sheets as they're made, pull them in the worker pool
+    while (piece := await run_sync(next, pieces, None)) is not None:
+        if piece:
+            yield piece
@@ -1,8 +1,39 @@
+import os
+import json
+from functools import partial
+from typing import Annotated, Literal
 from datetime import date, datetime
-from fastapi import APIRouter, Request
-from pydantic import BaseModel, EmailStr
+from fastapi import APIRouter, HTTPException, Request, Response, Query
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, EmailStr, Field
+from googleapiclient.errors import HttpError
 
-from ..handlers.google_drive import list_spreadsheets, copy_file, share_file, move_file
+from ..handlers.google_drive import (
+    SPREADSHEET,
+    PAGE_SIZE,
+    list_spreadsheets,
+    list_files_page,
+    iter_pages,
+    copy_file,
+    share_file,
+    move_file,
+    batch_get_files,
+    batch_get_parents,
+    batch_move_files,
+)
+from .export import attachment, iterate, zip_pieces
+from .conditional import (
+    listing_etag,
+    is_not_modified,
+    not_modified,
+    validator_headers,
+)
+from ..handlers.executor import run_sync
+
+# whole listings shared between workers, forgotten on changes made here
+LISTING_TTL = float(os.getenv("SHARED_CACHE_LISTING_TTL") or 30)
+
+END = object()
 
 
 class File(BaseModel):
@@ -12,6 +43,7 @@ class File(BaseModel):
     mimeType: str | None = None
     createdTime: date | datetime | None = None
     modifiedTime: date | datetime | None = None
+    version: str | None = None
 
     model_config = {
         "json_schema_extra": {
@@ -23,6 +55,7 @@ class File(BaseModel):
                     "mimeType": "application/vnd.google-apps.spreadsheet",
                     "createdTime": "2024-11-22T15:29:44.226000Z",
                     "modifiedTime": "2024-11-24T15:39:20.537000Z",
+                    "version": "12",
                 }
             ]
         }
@@ -34,38 +67,302 @@ class Metadata(BaseModel):
     email: EmailStr
 
 
+class FileIds(BaseModel):
+    ids: list[str] = Field(min_length=1, max_length=1000)
+
+
+class BulkResult(BaseModel):
+    id: str
+    status: Literal["ok", "error"]
+    detail: str | None = None
+
+
+def failed(file_id, error):
+    detail = error.reason if isinstance(error, HttpError) else error
+    return {"id": file_id, "status": "error", "detail": detail}
+
+
+def forget_listings(request, *folders):
+    for folder in folders:
+        parent = request.app.folders[folder]
+        request.app.single_flight.forget(parent)
+        if request.app.shared_cache:
+            request.app.shared_cache.delete(f"listing:{parent}")
+
+
+def forget_itinerary(request, id):
+    request.app.itinerary_cache.invalidate(id)
+    request.app.single_flight.forget(id)
+    if request.app.shared_cache:
+        request.app.shared_cache.delete(f"itinerary:{id}")
+    if request.app.replica:
+        request.app.replica.invalidate(id)
+
+
+async def check_parents(request, ids, folder):
+    """Split `ids` into files found in `folder` and results for the others."""
+    parent_id = request.app.folders[folder]
+    index = request.app.folder_index
+
+    ids = list(dict.fromkeys(ids))
+    if index and index.is_fresh():
+        confirmed = [id for id in ids if index.parent(id) == parent_id]
+    else:
+        confirmed = []
+
+    # the index may lag behind, ask drive about the rest in one batch
+    unknown = [id for id in ids if id not in confirmed]
+    parents = await run_sync(batch_get_parents, request.app.credentials, unknown)
+
+    rejected = {}
+    for id, (response, error) in zip(unknown, parents):
+        if error:
+            rejected[id] = failed(id, error)
+        elif parent_id in response.get("parents", []):
+            confirmed.append(id)
+        else:
+            rejected[id] = failed(id, f"Not in {folder}")
+
+    return [id for id in ids if id not in rejected], rejected
+
+
+async def move_files(request, ids, source, target):
+    """Move files from one itinerary folder to the other, in batches."""
+    # one result per file, in the order they were asked for
+    results = dict.fromkeys(ids)
+    ids, rejected = await check_parents(request, ids, source)
+    results.update(rejected)
+
+    moved = await run_sync(
+        batch_move_files,
+        request.app.credentials,
+        ids,
+        parent_id=request.app.folders[target],
+        remove_parent_id=request.app.folders[source],
+    )
+
+    forget_listings(request, source, target)
+
+    for id, (response, error) in zip(ids, moved):
+        if error:
+            results[id] = failed(id, error)
+            continue
+
+        results[id] = {"id": id, "status": "ok"}
+        forget_itinerary(request, id)
+        if request.app.folder_index:
+            request.app.folder_index.upsert(response, request.app.folders[target])
+
+    return list(results.values())
+
+
+async def list_folder(request, response, folder, page_size, cursor, format):
+    """List the spreadsheets in a folder as a whole, one page, or an NDJSON stream."""
+    credentials = request.app.credentials
+    parent = request.app.folders[folder]
+
+    # serve whole listings from the synced index while it is fresh
+    index = request.app.folder_index
+    local = index and index.is_fresh() and not (page_size or cursor)
+
+    if format == "ndjson" or "application/x-ndjson" in request.headers.get(
+        "accept", ""
+    ):
+        if local:
+            files = index.list(parent)
+            return StreamingResponse(
+                (json.dumps(file) + "\n" for file in files),
+                media_type="application/x-ndjson",
+            )
+
+        pages = iter_pages(
+            credentials,
+            mime_type=SPREADSHEET,
+            parent=parent,
+            page_size=page_size or PAGE_SIZE,
+            page_token=cursor,
+        )
+
+        # read the first page up front, so a failed listing still gets its status
+        first = await run_sync(next, pages)
+        if first is None:
+            raise HTTPException(status_code=502, detail=f"Could not list {folder}")
+
+        async def stream():
+            # fetch one page at a time, so the first files are sent right away
+            page = first
+            while page is not END:
+                if page is None:
+                    # a failed page mustn't look like the end of the listing
+                    yield json.dumps(
+                        {"error": f"Could not list all of {folder}"}
+                    ) + "\n"
+                    raise RuntimeError(f"Listing {parent} failed after a page")
+
+                for file in page["files"]:
+                    yield json.dumps(file) + "\n"
+                page = await run_sync(next, pages, END)
+
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+    # identical listings requested at the same time share one call
+    flights = request.app.single_flight
+
+    if page_size or cursor:
+        page = await flights.run(
+            ("page", parent, page_size, cursor),
+            partial(
+                list_files_page,
+                credentials,
+                mime_type=SPREADSHEET,
+                parent=parent,
+                page_size=page_size or PAGE_SIZE,
+                page_token=cursor,
+            ),
+        )
+        if page and page["nextPageToken"]:
+            response.headers["X-Next-Cursor"] = page["nextPageToken"]
+
+        files = page and page["files"]
+    elif local:
+        files = index.list(parent)
+    elif request.app.shared_cache:
+        files = await flights.run(
+            ("listing", parent),
+            partial(
+                request.app.shared_cache.get_or_fetch,
+                f"listing:{parent}",
+                partial(list_spreadsheets, credentials, parent=parent),
+                LISTING_TTL,
+            ),
+            keep=True,
+        )
+    else:
+        files = await flights.run(
+            ("listing", parent),
+            partial(list_spreadsheets, credentials, parent=parent),
+            keep=True,
+        )
+
+    if files is not None:
+        # no Last-Modified, removing a file doesn't advance any modifiedTime
+        etag = listing_etag(files)
+
+        if is_not_modified(request, etag):
+            return not_modified(etag)
+
+        response.headers.update(validator_headers(etag))
+
+    return files
+
+
 router = APIRouter()
 
 
 @router.get("", response_model_exclude_none=True)
-async def get_itineraries(request: Request) -> list[File]:
-    response = list_spreadsheets(
-        request.app.credentials, parent=request.app.folders["Itineraries"]
+async def get_itineraries(
+    request: Request,
+    response: Response,
+    page_size: Annotated[int | None, Query(ge=1, le=1000)] = None,
+    cursor: str | None = None,
+    format: Literal["json", "ndjson"] = "json",
+) -> list[File]:
+    return await list_folder(
+        request, response, "Itineraries", page_size, cursor, format
+    )
+
+
+@router.get("/export")
+async def export_itineraries(
+    request: Request,
+    ids: Annotated[list[str], Query(min_length=1, max_length=100)],
+    format: Literal["csv", "ics", "jsonl"] = "csv",
+):
+    """A ZIP with one CSV, iCalendar or JSON Lines export per itinerary."""
+    ids = list(dict.fromkeys(ids))
+    results = await run_sync(batch_get_files, request.app.credentials, ids)
+
+    missing = [id for (id, (_, error)) in zip(ids, results) if error]
+    if missing:
+        raise HTTPException(
+            status_code=404, detail=f"Could not find {', '.join(missing)}"
+        )
+
+    if request.app.write_behind:
+        for id in ids:
+            await request.app.write_behind.flush(id)
+
+    files = [file for (file, _) in results]
+
+    return StreamingResponse(
+        iterate(zip_pieces(request.app.credentials, format, files)),
+        media_type="application/zip",
+        headers={"Content-Disposition": attachment(f"itineraries-{format}.zip")},
     )
-    return response
 
 
 @router.post("", response_model_exclude_none=True)
 async def create_itinerary(request: Request, body: Metadata) -> File:
-    response = copy_file(
-        request.app.credentials,
-        file_id=request.app.template_id,
-        name=body.name,
-        parent_id=request.app.folders["Itineraries"],
-    )
+    pool = request.app.template_pool
+    response = None
 
-    share_file(
-        request.app.credentials, file_id=response["id"], email_address=body.email
-    )
+    if pool:
+        # a staged copy only needs renaming and moving
+        response = await run_sync(
+            pool.assign, body.name, request.app.folders["Itineraries"]
+        )
+        pool.wake()
+
+    if response is None:
+        response = await run_sync(
+            copy_file,
+            request.app.credentials,
+            file_id=request.app.template_id,
+            name=body.name,
+            parent_id=request.app.folders["Itineraries"],
+        )
+        if response is None:
+            # failed copies aren't retried, they may have been made
+            raise HTTPException(status_code=502, detail="Could not copy the template")
+
+    if request.app.folder_index:
+        request.app.folder_index.upsert(response, request.app.folders["Itineraries"])
+    forget_listings(request, "Itineraries")
+
+    try:
+        await run_sync(
+            share_file,
+            request.app.credentials,
+            file_id=response["id"],
+            email_address=body.email,
+        )
+    except HttpError as error:
+        print(f"An error occurred: {error}")
+        raise HTTPException(
+            status_code=502, detail=f"Created {response['id']} but could not share it"
+        )
 
     return response
 
 
+@router.post("/archive", response_model_exclude_none=True)
+async def archive_itineraries(request: Request, body: FileIds) -> list[BulkResult]:
+    return await move_files(request, body.ids, "Itineraries", "Archives")
+
+
 @router.delete("/{id}")
 async def archive_itinerary(request: Request, id: str):
-    response = move_file(
+    response = await run_sync(
+        move_file,
         request.app.credentials,
         file_id=id,
         parent_id=request.app.folders["Archives"],
+        remove_parent_id=request.app.folders["Itineraries"],
     )
+    forget_itinerary(request, id)
+    forget_listings(request, "Itineraries", "Archives")
+
+    if request.app.folder_index and response:
+        request.app.folder_index.upsert(response, request.app.folders["Archives"])
+
     return response
@@ -0,0 +1,35 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import PlainTextResponse
+
+from ..handlers.metrics import registry, stats_samples
+from ..handlers.scheduler import scheduler
+
+router = APIRouter()
+
+
+@router.get("", response_class=PlainTextResponse)
+def get_metrics(request: Request):
+    app = request.app
+    components = {
+        "google_api_scheduler": scheduler,
+        "itinerary_cache": app.itinerary_cache,
+        "write_behind": app.write_behind,
+        "folder_index": app.folder_index,
+        "replica": app.replica,
+        "credentials": app.credential_manager,
+        "shared_cache": app.shared_cache,
+        "single_flight": app.single_flight,
+        "search_index": app.search_index,
+        "template_pool": app.template_pool,
+    }
+
+    gauges, counters = [], []
+    for prefix, component in components.items():
+        if component is not None:
+            samples = stats_samples(prefix, component.stats(), component.counters)
+            gauges += samples[0]
+            counters += samples[1]
+
+    return PlainTextResponse(
+        registry.render(gauges, counters), media_type="text/plain; version=0.0.4"
+    )
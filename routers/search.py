@@ -0,0 +1,61 @@
+from typing import Annotated, Literal
+from datetime import date
+from fastapi import APIRouter, HTTPException, Request, Response, Query
+
+from .update_itineraries import Category, Resource
+
+
+class SearchResult(Resource):
+    itinerary_id: str
+    itinerary_name: str
+    folder: str
+    category: Category
+
+
+router = APIRouter()
+
+
+@router.get("", response_model_exclude_none=True)
+async def search_itineraries(
+    request: Request,
+    response: Response,
+    q: str | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    category: Annotated[list[Category] | None, Query()] = None,
+    folder: Literal["Itineraries", "Archives"] | None = None,
+    limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+    offset: Annotated[int, Query(ge=0)] = 0,
+) -> list[SearchResult]:
+    """Rows of any itinerary with every word of `q` and dates in the range."""
+    index = request.app.search_index
+
+    if index is None:
+        raise HTTPException(status_code=404, detail="Search is not enabled")
+    if not index.is_ready():
+        raise HTTPException(
+            status_code=503,
+            detail="The search index is being built",
+            headers={"Retry-After": "5"},
+        )
+
+    folders = {folder_id: name for (name, folder_id) in request.app.folders.items()}
+
+    hits = index.search(
+        q,
+        date_from=date_from,
+        date_to=date_to,
+        categories=[item.value for item in category or Category],
+        folder_ids=[request.app.folders[folder]] if folder else None,
+    )
+    response.headers["X-Total-Count"] = str(len(hits))
+
+    return [
+        {
+            **row,
+            "itinerary_id": file["id"],
+            "itinerary_name": file["name"],
+            "folder": folders.get(folder_id),
+        }
+        for (file, folder_id, row) in hits[offset : offset + limit]
+    ]
@@ -0,0 +1,95 @@
+import os
+import json
+
+from fastapi import Response
+
+from ..handlers.google_sheets import COLUMNS
+
+try:
+    import orjson
+except ImportError:  # optional, `pip install orjson`
+    orjson = None
+
+# skip response model validation for itinerary payloads
+FAST_SERIALIZATION = (os.getenv("FAST_SERIALIZATION") or "").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+COLUMNAR = "application/vnd.itineraries.columnar+json"
+
+FILE_FIELDS = [
+    "name",
+    "id",
+    "kind",
+    "mimeType",
+    "createdTime",
+    "modifiedTime",
+    "version",
+]
+# in the order of the `Resource` model
+ROW_FIELDS = ["name", "index", *[column for column in COLUMNS if column != "name"]]
+COST = ROW_FIELDS.index("cost")
+
+
+def dumps(payload):
+    if orjson:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def wants_columnar(request):
+    return COLUMNAR in request.headers.get("accept", "")
+
+
+def cost(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def row_dict(row):
+    """Row as the `Resource` model would serialize it, without validating."""
+    values = {}
+    for field in ROW_FIELDS:
+        value = row.get(field)
+        if field == "cost":
+            value = cost(value)
+        if value is not None:
+            values[field] = value
+    return values
+
+
+def row_values(row):
+    values = [row.get(field) for field in ROW_FIELDS]
+    values[COST] = cost(values[COST])
+    return values
+
+
+def itinerary_payload(file, data, columnar=False):
+    payload = {field: file[field] for field in FILE_FIELDS if file.get(field)}
+
+    if columnar:
+        # field names once, then one array of values per row
+        payload["columns"] = ROW_FIELDS
+        payload["data"] = {
+            category: [row_values(row) for row in rows]
+            for (category, rows) in data.items()
+        }
+    else:
+        payload["data"] = {
+            category: [row_dict(row) for row in rows]
+            for (category, rows) in data.items()
+        }
+
+    return payload
+
+
+def itinerary_response(file, data, columnar=False, headers=None):
+    return Response(
+        dumps(itinerary_payload(file, data, columnar)),
+        media_type=COLUMNAR if columnar else "application/json",
+        headers=headers,
+    )
@@ -1,14 +1,37 @@
-from typing import Annotated
+import asyncio
+from functools import partial
+from typing import Annotated, Literal
 from datetime import date, datetime
 from enum import Enum
-from fastapi import APIRouter, Request, Path
+from fastapi import APIRouter, Request, Response, Path, Query
 from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 
-from .manage_itineraries import File
+from .manage_itineraries import File, forget_itinerary
+from .conditional import (
+    file_etag,
+    last_modified,
+    is_conditional,
+    is_not_modified,
+    not_modified,
+    validator_headers,
+)
+from .export import MEDIA_TYPES, attachment, filename, iterate, itinerary_pieces
+from .serialization import (
+    FAST_SERIALIZATION,
+    dumps,
+    row_dict,
+    wants_columnar,
+    itinerary_response,
+)
+from ..handlers.executor import run_sync
 from ..handlers.google_drive import get_file
+from ..handlers.row_index import RowIndex
 from ..handlers.google_sheets import (
-    get_spreadsheet_data,
+    iter_row_chunks,
+    batch_get_spreadsheet_data,
+    batch_update_sheets,
     append_sheet,
     update_row,
     delete_row,
@@ -50,55 +73,341 @@ class Resource(BaseModel):
 
 
 class Data(BaseModel):
-    activities: list[Resource] = []
-    housing: list[Resource] = []
-    transportation: list[Resource] = []
+    # categories left out of a query are omitted
+    activities: list[Resource] | None = None
+    housing: list[Resource] | None = None
+    transportation: list[Resource] | None = None
 
 
 class Itinerary(File):
     data: Data
 
 
+class Operation(str, Enum):
+    create = "create"
+    update = "update"
+    delete = "delete"
+
+
+class Mutation(BaseModel):
+    op: Operation
+    category: Category
+    index: int | None = None
+    data: Resource | None = None
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "op": "update",
+                    "category": "activities",
+                    "index": 2,
+                    "data": {"name": "Hiking", "date_start": "2024-12-01"},
+                }
+            ]
+        }
+    }
+
+
+class MutationResult(BaseModel):
+    op: Operation
+    category: Category
+    index: int | None = None
+    status: str
+    detail: str | None = None
+
+
 router = APIRouter()
 
+DEFAULT_QUERY = {
+    "date_from": None,
+    "date_to": None,
+    "cost_min": None,
+    "cost_max": None,
+    "sort": "index",
+    "descending": False,
+    "offset": 0,
+    "limit": None,
+}
 
-@router.get("/{id}", response_model_exclude_none=True)
-async def get_itinerary_activities(request: Request, id: str) -> Itinerary:
-    file = get_file(request.app.credentials, id)
 
-    activities = get_spreadsheet_data(
-        request.app.credentials, spreadsheet_id=id, range_name="activities"
+async def fetch_categories(request, file, data, categories):
+    """Add the categories missing from `data`, from the replica, cache or sheets."""
+    replica = request.app.replica
+    shared = request.app.shared_cache
+    missing = [category for category in categories if category not in data]
+
+    if not missing:
+        return data
+
+    if replica:
+        fetched = await run_sync(replica.get, file["id"], file["modifiedTime"], missing)
+        if fetched is not None:
+            return {**data, **fetched}
+
+    if shared:
+        # one worker reads every category, the others use its result
+        key = ("values", file["id"], file["modifiedTime"])
+
+        def read():
+            data = batch_get_spreadsheet_data(
+                request.app.credentials,
+                spreadsheet_id=file["id"],
+                range_names=[category.value for category in Category],
+            )
+            return {"modifiedTime": file["modifiedTime"], "data": data}
+
+        def fetch():
+            # keyed by id alone so writes can delete it, the version is kept inside
+            entry = shared.get_or_fetch(
+                f"itinerary:{file['id']}",
+                read,
+                valid=lambda entry: entry["modifiedTime"] == file["modifiedTime"],
+            )
+            return entry["data"]
+
+    else:
+        key = ("values", file["id"], file["modifiedTime"], *missing)
+        fetch = partial(
+            batch_get_spreadsheet_data,
+            request.app.credentials,
+            spreadsheet_id=file["id"],
+            range_names=missing,
+        )
+
+    # concurrent reads of the same version share one call
+    fetched = await request.app.single_flight.run(key, fetch)
+
+    data = {**data, **fetched}
+    # the replica replaces all rows of an itinerary, store complete reads only
+    if replica and all(category.value in data for category in Category):
+        await run_sync(replica.store, file, data)
+
+    return data
+
+
+async def file_metadata(request, id):
+    """Drive metadata of an itinerary, from Drive only when nothing local has it.
+
+    With the replica on, the replica or else the folder index answer, unless
+    the itinerary was written to since the replica stored it: the index may
+    not have seen that write yet.
+    """
+    replica = request.app.replica
+    index = request.app.folder_index
+
+    if replica:
+        file = await run_sync(replica.file, id)
+        if file:
+            return file
+
+        if file is None and index and index.is_fresh():
+            file = index.file(id)
+            if file and "modifiedTime" in file:
+                return file
+
+    return await request.app.single_flight.run(
+        ("file", id), partial(get_file, request.app.credentials, id), keep=True
     )
 
-    housing = get_spreadsheet_data(
-        request.app.credentials, spreadsheet_id=id, range_name="housing"
+
+async def last_row_index(request, id, category):
+    """Index of the last row of a category in the spreadsheet itself."""
+    file = await file_metadata(request, id)
+
+    cached = request.app.itinerary_cache.get(id, file["modifiedTime"]) or {}
+    data = await fetch_categories(request, file, cached, [category])
+    if data is not cached:
+        request.app.itinerary_cache.set(id, file["modifiedTime"], data)
+
+    rows = data[category]
+    return rows[-1]["index"] if rows else 0
+
+
+@router.get("/{id}", response_model_exclude_none=True)
+async def get_itinerary_activities(
+    request: Request,
+    response: Response,
+    id: str,
+    category: Annotated[list[Category] | None, Query()] = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    cost_min: float | None = None,
+    cost_max: float | None = None,
+    sort: Literal["index", "name", "date_start", "date_end", "cost"] = "index",
+    order: Literal["asc", "desc"] = "asc",
+    limit: Annotated[int | None, Query(ge=1, le=1000)] = None,
+    offset: Annotated[int, Query(ge=0)] = 0,
+) -> Itinerary:
+    cache = request.app.itinerary_cache
+    write_behind = request.app.write_behind
+    pending = write_behind and write_behind.has_pending(id)
+
+    # concurrent requests for the itinerary share its upstream reads
+    flights = request.app.single_flight
+    metadata = partial(get_file, request.app.credentials, id)
+
+    # only the requested category ranges are read from the sheets
+    categories = [item.value for item in category or Category]
+
+    columnar = wants_columnar(request)
+    variant = "columnar" if columnar else None
+    response.headers["Vary"] = "Accept"
+
+    if (
+        id in cache
+        or request.app.replica
+        or request.app.shared_cache
+        or (is_conditional(request) and not pending)
+    ):
+        # check the request and cached/replicated data against the drive metadata
+        file = await file_metadata(request, id)
+
+        etag = file_etag(file, variant)
+        modified = last_modified([file])
+
+        if not pending and is_not_modified(request, etag, modified):
+            return not_modified(etag, modified, {"Vary": "Accept"})
+
+        cached = cache.get(id, file["modifiedTime"]) or {}
+        data = await fetch_categories(request, file, cached, categories)
+
+        if data is not cached:
+            cache.set(id, file["modifiedTime"], data)
+    else:
+        # drive metadata and the category ranges are fetched concurrently
+        file, data = await asyncio.gather(
+            flights.run(("file", id), metadata, keep=True),
+            flights.run(
+                ("values", id, None, *categories),
+                partial(
+                    batch_get_spreadsheet_data,
+                    request.app.credentials,
+                    spreadsheet_id=id,
+                    range_names=categories,
+                ),
+            ),
+        )
+        cache.set(id, file["modifiedTime"], data)
+
+    if pending:
+        data = write_behind.overlay(id, data)
+    else:
+        response.headers.update(
+            validator_headers(file_etag(file, variant), last_modified([file]))
+        )
+
+    query = {
+        "date_from": date_from,
+        "date_to": date_to,
+        "cost_min": cost_min,
+        "cost_max": cost_max,
+        "sort": sort,
+        "descending": order == "desc",
+        "offset": offset,
+        "limit": limit,
+    }
+
+    if query == DEFAULT_QUERY:
+        rows = {category: data[category] for category in categories}
+    else:
+        rows = {}
+        for category in categories:
+            # buffered writes aren't in the cached index, index the overlay
+            index = None if pending else cache.index(id, file["modifiedTime"], category)
+            rows[category] = (index or RowIndex(data[category])).query(**query)
+
+    if columnar or FAST_SERIALIZATION:
+        # encode the rows directly instead of through the response model
+        return itinerary_response(file, rows, columnar, response.headers)
+
+    return {**file, "data": rows}
+
+
+@router.post("/{id}/batch", response_model_exclude_none=True)
+async def batch_update_activities(
+    request: Request, id: str, body: list[Mutation]
+) -> list[MutationResult]:
+    operations = [
+        {
+            "op": mutation.op.value,
+            "sheet_name": mutation.category.value,
+            "index": mutation.index,
+            "data": jsonable_encoder(mutation.data) if mutation.data else None,
+        }
+        for mutation in body
+    ]
+
+    if request.app.write_behind:
+        await request.app.write_behind.flush(id)
+
+    results = await run_sync(
+        batch_update_sheets,
+        request.app.credentials,
+        spreadsheet_id=id,
+        operations=operations,
     )
 
-    transportation = get_spreadsheet_data(
-        request.app.credentials, spreadsheet_id=id, range_name="transportation"
+    forget_itinerary(request, id)
+
+    return [{**result, "category": result["sheet_name"]} for result in results]
+
+
+@router.get("/{id}/export")
+async def export_itinerary(
+    request: Request, id: str, format: Literal["csv", "ics", "jsonl"] = "csv"
+):
+    """Every category of the itinerary as a CSV, iCalendar or JSON Lines download."""
+    if request.app.write_behind:
+        await request.app.write_behind.flush(id)
+
+    file = await run_sync(get_file, request.app.credentials, id)
+
+    return StreamingResponse(
+        iterate(itinerary_pieces(request.app.credentials, format, file)),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": attachment(filename(file["name"], format))},
     )
 
-    return {
-        **file,
-        "data": {
-            "activities": activities,
-            "housing": housing,
-            "transportation": transportation,
-        },
-    }
+
+@router.get("/{id}/{category}")
+async def stream_activities(request: Request, id: str, category: Category):
+    """Rows of one category as NDJSON, sent as each window of the sheet is read."""
+    if request.app.write_behind:
+        # buffered writes may append rows, number rows as the sheet will have them
+        await request.app.write_behind.flush(id)
+
+    chunks = iter_row_chunks(request.app.credentials, id, category.value)
+    # read the first window up front, so a missing sheet still gets its status
+    first = await run_sync(next, chunks, None)
+
+    async def stream():
+        chunk = first
+        while chunk is not None:
+            yield b"".join(dumps(row_dict(row)) + b"\n" for row in chunk)
+            chunk = await run_sync(next, chunks, None)
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
 
 
 @router.post("/{id}/{category}")
 async def create_activity(
     request: Request, id: str, category: Category, body: Resource
 ):
-    response = append_sheet(
+    if request.app.write_behind:
+        request.app.write_behind.append(id, category.value, jsonable_encoder(body))
+        return JSONResponse(status_code=202, content={"status": "queued"})
+
+    response = await run_sync(
+        append_sheet,
         request.app.credentials,
         spreadsheet_id=id,
         sheet_name=category.value,
         data=jsonable_encoder([body]),
     )
 
+    forget_itinerary(request, id)
+
     return response
 
 
@@ -110,7 +419,18 @@ async def overwrite_activity(
     category: Category,
     body: Resource,
 ):
-    response = update_row(
+    if request.app.write_behind:
+        await request.app.write_behind.update(
+            id,
+            category.value,
+            index,
+            jsonable_encoder(body),
+            last_index=partial(last_row_index, request, id, category.value),
+        )
+        return JSONResponse(status_code=202, content={"status": "queued"})
+
+    response = await run_sync(
+        update_row,
         request.app.credentials,
         spreadsheet_id=id,
         sheet_name=category.value,
@@ -118,6 +438,8 @@ async def overwrite_activity(
         data=jsonable_encoder(body),
     )
 
+    forget_itinerary(request, id)
+
     return response
 
 
@@ -128,11 +450,18 @@ async def delete_activity(
     index: int,
     category: Category,
 ):
-    response = delete_row(
+    if request.app.write_behind:
+        # deletes shift row indexes, apply buffered writes first
+        await request.app.write_behind.flush(id)
+
+    response = await run_sync(
+        delete_row,
         request.app.credentials,
         spreadsheet_id=id,
         sheet_name=category.value,
         index=index,
     )
 
+    forget_itinerary(request, id)
+
     return response